@@ -5,7 +5,10 @@ import sys
 # Add the parent directory to sys.path to import shipyard
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
+import anyio
+
 from shipyard.cli import ShipyardCLI
+from shipyard.engines.dagger import build_matrix
 
 # Configuration
 # List of (directory, package_name) tuples
@@ -21,40 +24,32 @@ IMAGES = [
     "archlinux:base-devel"
 ]
 
-def build_project(project_dir, package, image):
-    print(f"\n{'='*60}")
-    print(f"Building {package} in {project_dir} on {image}")
-    print(f"{ '='*60}\n")
-    
-    # Change to project directory so ShipyardCLI finds the shipfile
+# Number of builds to run at once
+JOBS = 4
+
+def project_builds(project_dir, package):
+    """Export the patch for a project and return a build for each image"""
     original_cwd = os.getcwd()
     try:
+        # Change to project directory so ShipyardCLI finds the shipfile
         os.chdir(project_dir)
         cli = ShipyardCLI(directory=".")
-        # We need to manually call the async build logic or use the cli wrapper if possible.
-        # ShipyardCLI.build uses anyio.run internally, so we can just call it.
-        # Note: output_dir is hardcoded in CLI to "build-output", which will be relative to project_dir
-        
-        # We catch SystemExit because fire/CLI might exit on error, 
-        # but ShipyardCLI.build just prints and exits on some errors. 
-        # Actually ShipyardCLI.build calls exit(1) on import error or export error.
-        # We'll try to run it.
-        
-        cli.build(image=image, package=package)
-        
+        # ShipyardCLI exits on errors (bad shipfile, failed export)
+        package, patch_content = cli._build_patch(package)
     except SystemExit as e:
-        if e.code != 0:
-            print(f"[-] Build failed for {package} on {image} with exit code {e.code}")
-        else:
-             print(f"[+] Build finished for {package} on {image}")
+        print(f"[-] Could not prepare {package} in {project_dir} (exit code {e.code})")
+        return []
     except Exception as e:
-        print(f"[-] An error occurred: {e}")
+        print(f"[-] An error occurred preparing {package}: {e}")
+        return []
     finally:
         os.chdir(original_cwd)
+    return [(image, package, patch_content) for image in IMAGES]
 
 def main():
     base_dir = os.getcwd()
     
+    builds = []
     for project_dir, package in PROJECTS:
         # Resolve absolute path for project dir
         abs_project_dir = os.path.join(base_dir, project_dir)
@@ -63,8 +58,14 @@ def main():
             print(f"[!] Project directory not found: {abs_project_dir}")
             continue
 
-        for image in IMAGES:
-            build_project(abs_project_dir, package, image)
+        builds += project_builds(abs_project_dir, package)
+
+    if not builds:
+        return
+    # Every build shares one Dagger session, artifacts go to build-output/<image>/
+    results = anyio.run(build_matrix, builds, os.path.join(base_dir, "build-output"), "", JOBS)
+    if not all(r.ok for r in results):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,7 @@
 from .codepatch import CodePatch as CodePatch
 from .codepatch import CodePatch as Patch
 from .ez import EZ as EZ
-from .version import Version as Version
+from .version import Version as Version, VersionIndex as VersionIndex
 from .git import SourceProgram as SourceProgram, SourceManager as SourceManager
 
-__all__ = ["CodePatch", "Patch", "EZ", "Version", "SourceProgram", "SourceManager"]
\ No newline at end of file
+__all__ = ["CodePatch", "Patch", "EZ", "Version", "VersionIndex", "SourceProgram", "SourceManager"]
\ No newline at end of file
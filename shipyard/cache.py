@@ -0,0 +1,144 @@
+# Small on-disk stores for results that are expensive to compute. They live in the
+# project directory (.shipyard/) and are keyed by hashes of everything that went in
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+def digest(*parts) -> str:
+    """Hash the parts (strings, bytes or anything with a stable repr) into a key"""
+    h = hashlib.sha256()
+    for p in parts:
+        if isinstance(p, str):
+            p = p.encode("utf-8", "surrogateescape")
+        elif not isinstance(p, bytes):
+            p = repr(p).encode("utf-8")
+        # Hash each part first so ("ab", "c") and ("a", "bc") differ
+        h.update(hashlib.sha256(p).digest())
+    return h.hexdigest()
+
+def cache_dir(*parts) -> str:
+    """A directory for caches shared by every project of the user ($XDG_CACHE_HOME/shipyard)"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    d = os.path.join(base, "shipyard", *parts)
+    os.makedirs(d, exist_ok=True)
+    return d
+
+def file_digest(filename: str) -> str:
+    """sha256 of a file's contents"""
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Cache:
+    """A directory of JSON entries, one file per key. Entries that have not been used
+    for max_age seconds are dropped, and the least recently used ones are evicted once
+    the store holds more than max_entries or max_size bytes"""
+    suffix = ".json"
+
+    def __init__(self, directory: str, max_entries=10000, max_size=256 << 20, max_age=30*24*3600) -> None:
+        self.dir = directory
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.max_age = max_age
+        self._evicted = False
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.dir, key + self.suffix)
+
+    def get(self, key: str, default=None):
+        fpath = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(fpath) > self.max_age:
+                os.remove(fpath)
+                return default
+            with open(fpath) as f:
+                value = json.load(f)
+            os.utime(fpath) # Mark as recently used
+            return value
+        except (OSError, ValueError):
+            return default
+
+    def set(self, key: str, value) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+        if not self._evicted:
+            self._evicted = True
+            self.evict()
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp, self._path(key))
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def evict(self) -> None:
+        """Drop expired entries and trim the store down to its limits"""
+        try:
+            entries = [e for e in os.scandir(self.dir) if e.name.endswith(self.suffix)]
+        except OSError:
+            return
+        now = time.time()
+        keep = []
+        for e in entries:
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            if now - st.st_mtime > self.max_age:
+                self._remove(e.path)
+            else:
+                keep.append((st.st_mtime, st.st_size, e.path))
+        keep.sort(reverse=True)
+        total = 0
+        for i, (_, size, fpath) in enumerate(keep):
+            total += size
+            if i >= self.max_entries or total > self.max_size:
+                self._remove(fpath)
+
+    def _remove(self, fpath):
+        try:
+            os.remove(fpath)
+        except OSError:
+            pass
+
+class FileCache(Cache):
+    """A Cache whose entries are files written by someone else (like an exported
+    container image). Write to new_file() and hand the result to commit()"""
+    suffix = ".tar"
+
+    def __init__(self, directory: str, suffix=None, **kwargs) -> None:
+        super().__init__(directory, **kwargs)
+        if suffix is not None:
+            self.suffix = suffix
+
+    def get(self, key: str, default=None):
+        """The path of the entry, or default if there is none"""
+        fpath = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(fpath) > self.max_age:
+                os.remove(fpath)
+                return default
+            os.utime(fpath)
+            return fpath
+        except OSError:
+            return default
+
+    def new_file(self, key: str) -> str:
+        """A temporary path in the cache to write the entry for key to"""
+        os.makedirs(self.dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=key + "-", suffix=".tmp")
+        os.close(fd)
+        return tmp
+
+    def commit(self, tmp: str, key: str) -> str:
+        """Store the file written to tmp as the entry for key"""
+        if not self._evicted:
+            self._evicted = True
+            self.evict()
+        os.replace(tmp, self._path(key))
+        return self._path(key)
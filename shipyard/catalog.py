@@ -0,0 +1,186 @@
+# A persistent catalog of the version tags of a git repo: tag -> version -> commit -> tree.
+# It lives in the git directory and is only rebuilt when the tag refs or the shipfile change
+import os
+import json
+import fnmatch
+import tempfile
+import subprocess
+
+from shipyard.cache import digest, file_digest
+from shipyard.sources import SourceProgram
+from shipyard.version import Version, VersionIndex
+
+CATALOG_FORMAT = 1 # Bump when the layout of catalog.json changes
+
+def git_common_dir(directory: str) -> str:
+    """The git directory shared by a repo and its worktrees, found without running git"""
+    gd = os.path.join(directory, ".git")
+    if os.path.isfile(gd):
+        # A worktree: .git is a 'gitdir: <dir>' file and <dir>/commondir points back
+        with open(gd) as f:
+            gd = os.path.join(directory, f.read().partition("gitdir:")[2].strip())
+        common = os.path.join(gd, "commondir")
+        if os.path.isfile(common):
+            with open(common) as f:
+                gd = os.path.join(gd, f.read().strip())
+    return os.path.normpath(gd)
+
+class VersionCatalog:
+    """Every tag matching VersionTags with its commit, tree and version, plus the
+    results of the shipfile hooks (tag_to_version, is_version_ignored, version_to_tag)
+    for them. Saved to <git dir>/shipyard/catalog.json
+
+    The refs are checked with a few stats on every query. When they changed the
+    catalog is rebuilt with for-each-ref, reusing the trees and hook results of
+    tags that did not move. A changed shipfile runs the hooks again
+    """
+    def __init__(self, repo: SourceProgram, directory: str) -> None:
+        self.r = repo
+        self.dir = directory
+        self.git_dir = git_common_dir(directory)
+        self.filename = os.path.join(self.git_dir, "shipyard", "catalog.json")
+        self._data = None
+        self._index = None
+        self._to_tag = {} # Hook results for versions that are not in the catalog
+
+    def _hooks(self) -> str:
+        """A hash of everything the hooks depend on"""
+        shipfile = self.r._filepath
+        return digest(self.r.VersionTags, file_digest(shipfile) if os.path.isfile(shipfile) else "")
+
+    def _stamp(self) -> list:
+        """The mtimes of everything git touches when tags are added, moved or removed"""
+        stamp = []
+        packed = os.path.join(self.git_dir, "packed-refs")
+        if os.path.exists(packed):
+            st = os.stat(packed)
+            stamp.append(["packed-refs", st.st_mtime_ns, st.st_size])
+        tags = os.path.join(self.git_dir, "refs", "tags")
+        for root, _, _ in os.walk(tags):
+            stamp.append([os.path.relpath(root, tags), os.stat(root).st_mtime_ns])
+        return sorted(stamp)
+
+    def _load(self) -> dict:
+        """The catalog, from memory or disk as long as the refs did not change"""
+        stamp = self._stamp()
+        if self._data is not None and self._data["stamp"] == stamp:
+            return self._data
+        old = self._data
+        if old is None:
+            try:
+                with open(self.filename) as f:
+                    old = json.load(f)
+                if old.get("format") != CATALOG_FORMAT:
+                    old = None
+            except (OSError, ValueError):
+                old = None
+        hooks = self._hooks()
+        if old is None or old["stamp"] != stamp or old["hooks"] != hooks:
+            print(f"[*] Updating the version catalog of {self.dir}")
+            old = self._build(old, stamp, hooks)
+            self._save(old)
+        self._data = old
+        self._index = None
+        return self._data
+
+    def _build(self, old: dict, stamp: list, hooks: str) -> dict:
+        old_tags = old["tags"] if old else {}
+        same_hooks = old is not None and old["hooks"] == hooks
+        trees = {commit: tree for commit, tree, _ in old_tags.values()}
+        refs = {t: c for t, c in self._refs().items() if fnmatch.fnmatchcase(t, self.r.VersionTags)}
+        trees.update(self._trees(sorted({c for c in refs.values() if c and c not in trees})))
+
+        tags = {}
+        for tag, commit in refs.items():
+            if same_hooks and tag in old_tags:
+                version = old_tags[tag][2]
+            else:
+                version = Version(self.r.tag_to_version(tag))
+                version = str(version) if version and not self.r.is_version_ignored(version) else None
+            tags[tag] = [commit, trees.get(commit), version]
+
+        old_versions = old["versions"] if same_hooks else {}
+        versions = {}
+        for v in {t[2] for t in tags.values() if t[2]}:
+            versions[v] = old_versions.get(v) or self.r.version_to_tag(v)
+        versions = {v: versions[v] for v in sorted(versions, key=lambda v: (Version(v)._v, v))}
+        return {"format": CATALOG_FORMAT, "stamp": stamp, "hooks": hooks, "tags": tags, "versions": versions}
+
+    def _git(self, args, input=None) -> str:
+        res = subprocess.run(
+            args,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.dir,
+            input=input,
+            encoding="utf-8"
+        )
+        if res.returncode != 0:
+            raise ValueError(res.stderr)
+        return res.stdout
+
+    def _refs(self) -> dict:
+        """Map every tag to the commit it points at (None for tags of other objects)"""
+        out = self._git(["git", "for-each-ref", "--format=%(refname:strip=2) %(objecttype) %(objectname) %(*objecttype) %(*objectname)", "refs/tags"])
+        refs = {}
+        for line in out.splitlines():
+            tag, typ, oid, ptyp, poid = (line.split(" ") + ["", ""])[:5]
+            if ptyp:
+                typ, oid = ptyp, poid
+            refs[tag] = oid if typ == "commit" else None
+        return refs
+
+    def _trees(self, commits: list) -> dict:
+        """The tree of each commit. Only reads the commits, so partial clones do not go
+        fetching trees"""
+        if not commits:
+            return {}
+        out = self._git(["git", "log", "--no-walk=unsorted", "--stdin", "--format=%H %T"], input="\n".join(commits) + "\n")
+        return dict(line.split(" ") for line in out.splitlines() if " " in line)
+
+    def _save(self, data: dict):
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.filename), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.filename)
+        except OSError as e:
+            print(f"[!] Could not save the version catalog: {e}")
+
+    def invalidate(self):
+        """Forget what is in memory, the next query checks the refs again"""
+        self._data = None
+        self._index = None
+
+    def versions(self) -> VersionIndex:
+        """The sorted versions we care about, or just HEAD if there are none"""
+        data = self._load()
+        if self._index is None:
+            self._index = VersionIndex(data["versions"] or ["HEAD"])
+        return self._index
+
+    def tags(self) -> dict:
+        """Map every tag matching VersionTags (ignored versions included) to its commit"""
+        return {tag: entry[0] for tag, entry in self._load()["tags"].items()}
+
+    def tag(self, version) -> str:
+        """version_to_tag, memoized"""
+        tag = self._load()["versions"].get(str(version))
+        if tag is None:
+            tag = self._to_tag.get(version)
+            if tag is None:
+                tag = self._to_tag[version] = self.r.version_to_tag(version)
+        return tag
+
+    def _entry(self, version) -> list:
+        tags = self._load()["tags"]
+        entry = tags.get(self.tag(version))
+        return entry if entry else [None, None, None]
+
+    def commit(self, version) -> str:
+        """The commit of version, None if it is not a version tag"""
+        return self._entry(version)[0]
+
+    def tree(self, version) -> str:
+        """The tree of version, None if it is not a version tag"""
+        return self._entry(version)[1]
@@ -12,9 +12,16 @@ from shipyard.generator import new_project
 from shipyard.version import Version
 
 class ShipyardCLI:
-    def __init__(self, directory="."):
-        """Maintain a group of patches against a source repository"""
+    def __init__(self, directory=".", backend="git", cache=True):
+        """Maintain a group of patches against a source repository
+
+        backend: how to talk to the source repo. 'git' forks git for every operation,
+        'batch' keeps a git process running and caches tags and file listings
+        cache: reuse the results of earlier runs stored in <directory>/.shipyard (--nocache to disable)
+        """
         self.dir = directory
+        self.backend = backend
+        self.cache = cache
     
     def _load(self) -> Patches:
         # @TODO: Search any python files in the current dir for valid Shipfile objects
@@ -30,7 +37,7 @@ class ShipyardCLI:
             if os.path.exists(path):
                 # Detected a shipyard file in the current dir, assume this is the patch folder
                 d, _ = os.path.split(path)
-                return Patches(d)
+                return Patches(d, backend=self.backend, cache=self.cache)
             #except Exception as e:
                 #print(f"[!] Detected a shipyard.py file. But there were errors loading it: {e}", file=sys.stderr)
                 #exit(127)
@@ -55,19 +62,32 @@ class ShipyardCLI:
         """Download multiple URLs to create a properly tagged git repo."""
         pass
 
-    def versions(self):
-        """List the versions of the source code. Denoting which versions have patches"""
+    def versions(self, matrix=False, jobs=1):
+        """List the versions of the source code. Denoting which versions have patches
+
+        matrix: also check which patches apply to each version (without checking it out)
+        jobs: number of versions to check at once when building the matrix
+        """
         p = self._load()
         print(f"versions of {p.infoObject.Name}")
+        results = {}
+        if matrix:
+            results = {v: (seed, errs) for v, seed, errs in p.matrix(jobs=int(jobs))}
         for v in p.source.versions():
             # Print tag aswell as version
-            t = p.infoObject.version_to_tag(v)
+            t = p.source.tag(v)
             if t != v:
                 t = f"{v} - tags/{t}"
             if v in p.versions:
-                print(f"{t} - {len(p.versions[v])} patches")
-            else:
-                print(t)
+                t = f"{t} - {len(p.versions[v])} patches"
+            if v in results:
+                seed, errs = results[v]
+                if seed is not None:
+                    failed = sorted(n for n, e in errs.items() if e is not None)
+                    t = f"{t} - {len(errs)-len(failed)}/{len(errs)} apply from {seed}"
+                    if failed:
+                        t = f"{t} (failed: {', '.join(failed)})"
+            print(t)
 
     def import_patch(self, name, description=""):
         """import a new patchfile
@@ -96,8 +116,11 @@ class ShipyardCLI:
             of.write(p.dump())
         print("[+] Saved new patch file to", pth)
     
-    def test_patch(self, patchfile):
-        """Test a patch file against all versions"""
+    def test_patch(self, patchfile, jobs=1):
+        """Test a patch file against all versions
+
+        jobs: test this many versions at once, each in its own git worktree
+        """
         p = self._load()
         patch = patchfile
         if patchfile not in p.code_patches:
@@ -107,7 +130,7 @@ class ShipyardCLI:
                 print("[!] Could not load patchfile or CodePatch:", e, file=sys.stderr)
                 exit(127)
         try:
-            p.test_patch(patch)
+            p.test_patch(patch, jobs=int(jobs))
         except Exception as e:
             print("[!] Checkout branch:", e, file=sys.stderr)
             exit(127)
@@ -117,11 +140,27 @@ class ShipyardCLI:
         p = self._load()
         p.patch_version(version)
 
-    def export(self, version):
-        """Export the version into a single patchfile"""
+    def build_versions(self, jobs=1):
+        """Build patches for every version that does not have any, porting them from the
+        closest version that does
+
+        jobs: port this many chains of versions at once, each in its own git worktree
+        """
+        p = self._load()
+        try:
+            p.build_versions(jobs=int(jobs))
+        except Exception as e:
+            print("[!]", e, file=sys.stderr)
+            exit(127)
+
+    def export(self, version, jobs=1):
+        """Export the version into a single patchfile
+
+        jobs: number of processes to run the CodePatches with
+        """
         p = self._load()
         try:
-            res, patches = p.export(version)
+            res, patches = p.export(version, jobs=int(jobs))
         except Exception as e:
             print("[!]", e)
             quit(1)
@@ -134,55 +173,52 @@ class ShipyardCLI:
         for f in p._files:
             print(f)
     
-    def apply_code_patches(self, patches=[]):
-        """Apply all the code patches to the current source"""
+    def apply_code_patches(self, patches=[], jobs=1):
+        """Apply all the code patches to the current source
+
+        jobs: number of processes to run the CodePatches with
+        """
         p = self._load()
         p.get_file_list()
         try:
-            code_funcs, _ =  p.apply_code_patches()
+            code_funcs, _ =  p.apply_code_patches(jobs=int(jobs))
             for cf in code_funcs:
                 print(f"[+] applied {cf.__name__}")
         except Exception as e:
             print("[!]", e)
 
-    def checkout(self, version=""):
+    def checkout(self, version="", full=False):
         """Checkout the given version of the source. If not version is given it will reset the
-        source back to the original state of the current version"""
-        p = self._load()
-        p.source.reset()
-        if version:
-            p.source.checkout(Version(version))
+        source back to the original state of the current version
 
-    def build(self, image=None, package=None, version="", patch=None, interactive=False, artifacts=None, output=None, i=False, p=None):
-        """Build a package using Dagger orchestration.
-        
-        image: The base image to build on (e.g. debian:bookworm, rockylinux:9)
-        package: The name of the package to build. Optional if defined in Shipfile.
-        version: The version of the source code to use (optional, defaults to current/latest)
-        patch: Optional path to a .patch file, a Shipfile.py, or a directory containing a Shipfile.py
-        interactive: Drop into an interactive shell on failure or completion
-        artifacts: Glob pattern to filter exported artifacts (e.g. "openssh*.rpm")
-        output: Directory to save artifacts. If set, artifacts are saved in <output>/<image>/
+        full: check out every file, even when the shipfile asks for a SparseCheckout
         """
-        # Handle short flags
-        if i:
-            interactive = True
-        if p and not patch:
-            patch = p
-
-        if image is None or image.startswith("-"):
-            print("[!] Error: Image name is required and cannot start with a hyphen.", file=sys.stderr)
-            print("    Usage: shipyard build <image> [package] [--patch <path>] [--interactive]", file=sys.stderr)
-            exit(1)
+        p = self._load()
+        if version:
+            p._checkout(version, full=full)
+            return
+        p.source.reset()
+        if full:
+            p.source.sparse(None)
 
+    def fetch(self):
+        """Fetch the new tags (versions) of the source from upstream"""
+        p = self._load()
         try:
-            import anyio
-            from shipyard.engines.dagger import build_package
-        except ImportError as e:
-            print(f"[!] Dagger SDK or dependencies not found: {e}", file=sys.stderr)
-            print("    Please install with: pip install dagger-io anyio", file=sys.stderr)
-            exit(1)
+            new = p.source.fetch()
+        except Exception as e:
+            print("[!]", e)
+            return
+        if not new:
+            print("[*] No new tags")
+            return
+        print(f"[+] New tags: {', '.join(new)}")
 
+    def _build_patch(self, package=None, version="", patch=None) -> "tuple[str, str]":
+        """Work out the package name and the patch to build it with
+
+        Return: (package name, patch contents)
+        """
         p = None
         patch_content = ""
         
@@ -201,7 +237,7 @@ class ShipyardCLI:
                     directory = os.path.dirname(os.path.abspath(patch))
                     print(f"[*] Loading Shipfile from {directory}")
                     try:
-                        p = Patches(directory)
+                        p = Patches(directory, backend=self.backend, cache=self.cache)
                     except Exception as e:
                         print(f"[!] Failed to load shipfile {patch}: {e}", file=sys.stderr)
                         exit(1)
@@ -211,7 +247,7 @@ class ShipyardCLI:
             elif os.path.isdir(patch):
                 print(f"[*] Loading Shipfile from directory {patch}")
                 try:
-                    p = Patches(patch)
+                    p = Patches(patch, backend=self.backend, cache=self.cache)
                 except Exception as e:
                     print(f"[!] Failed to load from directory {patch}: {e}", file=sys.stderr)
                     exit(1)
@@ -259,13 +295,45 @@ class ShipyardCLI:
                 print("[!] Error: No patch content available. Provide a .patch file or a valid Shipfile.", file=sys.stderr)
                 exit(1)
         
+        return pkg_name, patch_content
+
+    def build(self, image=None, package=None, version="", patch=None, interactive=False, artifacts=None, output=None, incremental=False, ccache=False, i=False, p=None):
+        """Build a package using Dagger orchestration.
+        
+        image: The base image to build on (e.g. debian:bookworm, rockylinux:9)
+        package: The name of the package to build. Optional if defined in Shipfile.
+        version: The version of the source code to use (optional, defaults to current/latest)
+        patch: Optional path to a .patch file, a Shipfile.py, or a directory containing a Shipfile.py
+        interactive: Drop into an interactive shell on failure or completion
+        artifacts: Glob pattern to filter exported artifacts (e.g. "openssh*.rpm")
+        output: Directory to save artifacts. If set, artifacts are saved in <output>/<image>/
+        incremental: Reuse the container with the sources and build-deps from an earlier build, so only the patch and build run again
+        ccache: Compile through ccache, backed by a cache volume per image
+        """
+        # Handle short flags
+        if i:
+            interactive = True
+        if p and not patch:
+            patch = p
+
+        if image is None or image.startswith("-"):
+            print("[!] Error: Image name is required and cannot start with a hyphen.", file=sys.stderr)
+            print("    Usage: shipyard build <image> [package] [--patch <path>] [--interactive]", file=sys.stderr)
+            exit(1)
+
+        try:
+            import anyio
+            from shipyard.engines.dagger import build_package, image_output_dir
+        except ImportError as e:
+            print(f"[!] Dagger SDK or dependencies not found: {e}", file=sys.stderr)
+            print("    Please install with: pip install dagger-io anyio", file=sys.stderr)
+            exit(1)
+
+        pkg_name, patch_content = self._build_patch(package, version, patch)
+
         # Determine output directory
         if output:
-            image_parts = image.split(":")
-            if len(image_parts) > 1:
-                output_dir = os.path.join(output, *image_parts)
-            else:
-                output_dir = os.path.join(output, image)
+            output_dir = image_output_dir(output, image)
         else:
             output_dir = "build-output"
 
@@ -277,9 +345,53 @@ class ShipyardCLI:
             patch_content or "",
             output_dir or "",
             bool(interactive),
-            artifacts or ""
+            artifacts or "",
+            bool(self.cache),
+            bool(incremental),
+            bool(ccache)
         )
 
+    def build_matrix(self, images, packages=None, version="", patch=None, artifacts=None, output="build-output", jobs=4, incremental=False, ccache=False):
+        """Build the package(s) on several images at once, over a single Dagger session
+
+        images: images to build on, comma separated (e.g. debian:bookworm,rockylinux:9)
+        packages: packages to build, comma separated. Optional if defined in Shipfile.
+        version: The version of the source code to use (optional, defaults to current/latest)
+        patch: Optional path to a .patch file, a Shipfile.py, or a directory containing a Shipfile.py
+        artifacts: Glob pattern to filter exported artifacts (e.g. "openssh*.rpm")
+        output: Directory to save artifacts. Each image gets its own <output>/<image>/
+        jobs: number of builds to run at once
+        incremental: Reuse the containers with the sources and build-deps from earlier builds
+        ccache: Compile through ccache, backed by a cache volume per image
+        """
+        try:
+            import anyio
+            from shipyard.engines.dagger import build_matrix
+        except ImportError as e:
+            print(f"[!] Dagger SDK or dependencies not found: {e}", file=sys.stderr)
+            print("    Please install with: pip install dagger-io anyio", file=sys.stderr)
+            exit(1)
+
+        # fire hands us a tuple for a,b and a string for a single value
+        if isinstance(images, str):
+            images = images.split(",")
+        if isinstance(packages, str):
+            packages = packages.split(",")
+        images = [i.strip() for i in images if i.strip()]
+        if not images or any(i.startswith("-") for i in images):
+            print("[!] Error: At least one image is required and image names cannot start with a hyphen.", file=sys.stderr)
+            exit(1)
+
+        builds = []
+        for package in packages or [None]:
+            pkg_name, patch_content = self._build_patch(package, version, patch)
+            builds += [(image, pkg_name, patch_content) for image in images]
+
+        print(f"[*] Starting {len(builds)} builds, {int(jobs)} at a time...")
+        results = anyio.run(build_matrix, builds, output, artifacts or "", int(jobs), bool(self.cache), bool(incremental), bool(ccache))
+        if not all(r.ok for r in results):
+            exit(1)
+
 
 def run():
     #p = Patch.from_file(sys.argv[1])
@@ -1,3 +1,6 @@
+import re
+import inspect
+
 class CodePatch:
     """
     Custom patches that are not just "diff based". Instead they match filenames
@@ -18,3 +21,114 @@ class CodePatch:
         setattr(func, "__patch_required", self.required)
         setattr(func, "__patch_has_run", False)
         return func
+
+
+def _literal_suffix(pattern: re.Pattern) -> str:
+    """Return the literal text that every full match of pattern ends with ('' if unknown)"""
+    p = pattern.pattern
+    if not isinstance(p, str) or pattern.flags & (re.IGNORECASE | re.VERBOSE):
+        return ""
+    tokens = [] # Literal characters, None for anything that is not
+    i, depth = 0, 0
+    while i < len(p):
+        c = p[i]
+        if c == "\\":
+            n = p[i+1:i+2]
+            tokens.append(n if n and not n.isalnum() else None)
+            i += 2
+            continue
+        if c == "[":
+            i += 1
+            if p[i:i+1] == "^":
+                i += 1
+            if p[i:i+1] == "]":
+                i += 1
+            while i < len(p) and p[i] != "]":
+                i += 2 if p[i] == "\\" else 1
+            tokens.append(None)
+        elif c in "*+?{":
+            if tokens:
+                tokens[-1] = None
+            if c == "{":
+                end = p.find("}", i)
+                i = len(p) if end < 0 else end
+        elif c == "|" and depth == 0:
+            return "" # Top level alternation, could end with anything
+        elif c == "$" and i == len(p) - 1:
+            break
+        elif c in "().^$|":
+            depth += {"(": 1, ")": -1}.get(c, 0)
+            tokens.append(None)
+        else:
+            tokens.append(c)
+        i += 1
+    suffix = []
+    for t in reversed(tokens):
+        if t is None:
+            break
+        suffix.append(t)
+    return "".join(reversed(suffix))
+
+def _extension(s: str) -> str:
+    i = s.rfind(".")
+    if i < 0 or "/" in s[i:]:
+        return ""
+    return s[i:]
+
+def _combine(patterns: list) -> re.Pattern:
+    """Join patterns into a single alternation, or None if that would change their meaning"""
+    srcs = [p.pattern for p in patterns]
+    if not srcs or any(not isinstance(s, str) or p.flags & ~re.UNICODE or re.search(r"\\[1-9]|\(\?P=", s) for s, p in zip(srcs, patterns)):
+        return None
+    try:
+        return re.compile("|".join(f"(?:{s})" for s in srcs))
+    except re.error:
+        return None
+
+class CodePatchIndex:
+    """Maps a file path to the CodePatches that want it. Built once from the file regexes
+    so a file is bucketed by extension, patterns are prefiltered by their literal suffix,
+    and the patterns without one are gated by a single combined regex"""
+    def __init__(self, code_res: dict) -> None:
+        self.by_ext = {} # extension -> [(suffix, regex, funcs)]
+        others = []
+        for r, funcs in code_res.items():
+            suffix = _literal_suffix(r)
+            ext = _extension(suffix)
+            if ext:
+                self.by_ext.setdefault(ext, []).append((suffix, r, funcs))
+            else:
+                others.append((suffix, r, funcs))
+        self.others = others
+        self.others_re = _combine([r for _, r, _ in others])
+        # Some CodePatches take a version, check once instead of on every call
+        self.takes_version = {}
+        for funcs in code_res.values():
+            for f in funcs:
+                if f not in self.takes_version:
+                    self.takes_version[f] = len(inspect.getfullargspec(f).args) > 1
+        self._versions = {}
+
+    def match(self, rel_file: str) -> list:
+        """Return the CodePatches with a regex that matches rel_file (with or without a leading /)"""
+        stripped = rel_file.lstrip("/")
+        candidates = self.by_ext.get(_extension(rel_file), [])
+        if self.others:
+            if self.others_re is None or self.others_re.fullmatch(rel_file) or self.others_re.fullmatch(stripped):
+                candidates = candidates + self.others
+        funcs = []
+        for suffix, r, fs in candidates:
+            if not rel_file.endswith(suffix):
+                continue
+            if r.fullmatch(rel_file) or r.fullmatch(stripped):
+                funcs += [f for f in fs if f not in funcs]
+        return funcs
+
+    def runs_on(self, func, version) -> bool:
+        """Check if func should run on the given version"""
+        if version not in self._versions:
+            self._versions[version] = {
+                f for f in self.takes_version
+                if not getattr(f, "__patch_versions", []) or version in getattr(f, "__patch_versions", [])
+            }
+        return func in self._versions[version]
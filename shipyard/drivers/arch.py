@@ -2,6 +2,9 @@ from .base import DistroDriver
 import dagger
 
 class ArchDriver(DistroDriver):
+    def cache_volumes(self) -> dict:
+        return {"/var/cache/pacman/pkg": "pacman"}
+
     def setup(self, container: dagger.Container) -> dagger.Container:
         return (
             container
@@ -55,6 +58,20 @@ class ArchDriver(DistroDriver):
             .with_exec(["/bin/bash", "-c", "cd */ && patch -p1 < ../../shipyard.patch"])
         )
 
+    def ccache_wrappers(self) -> str:
+        return "/usr/lib/ccache/bin"
+
+    def ccache_owner(self) -> str:
+        return "builder"
+
+    def install_ccache(self, container: dagger.Container) -> dagger.Container:
+        return (
+            container
+            .with_user("root")
+            .with_exec(["pacman", "-S", "--noconfirm", "--needed", "ccache"])
+            .with_user("builder")
+        )
+
     def get_artifact_pattern(self, package: str) -> str:
         return r".*\.pkg\.tar\.zst$"
 
@@ -1,9 +1,84 @@
 from abc import ABC, abstractmethod
 import dagger
+import re
 
 class DistroDriver(ABC):
-    def __init__(self, image: str):
+    # Where the compiler cache volume is mounted when ccache is on
+    CCACHE_DIR = "/var/cache/shipyard-ccache"
+
+    def __init__(self, image: str, ccache: bool = False):
         self.image = image
+        self.ccache = ccache
+
+    def cache_volumes(self) -> dict:
+        """
+        Package manager caches to keep between builds, as {path in the container: volume name}.
+        """
+        return {}
+
+    def with_caches(self, client: dagger.Client, container: dagger.Container) -> dagger.Container:
+        """
+        Mount the cache volumes. Volumes are per image and locked while mounted, so builds on
+        the same image take turns installing packages instead of fighting over the lock.
+        """
+        image = re.sub(r"[^A-Za-z0-9_.-]", "-", self.image)
+        for p, name in self.cache_volumes().items():
+            container = container.with_mounted_cache(
+                p, client.cache_volume(f"shipyard-{name}-{image}"),
+                sharing=dagger.CacheSharingMode.LOCKED
+            )
+        return container
+
+    def without_caches(self, container: dagger.Container) -> dagger.Container:
+        """
+        Unmount the cache volumes once the packages are installed.
+        """
+        for p in self.cache_volumes():
+            container = container.without_mount(p)
+        return container
+
+    def ccache_wrappers(self) -> str:
+        """
+        Directory with the ccache compiler wrappers (gcc, cc, ...).
+        """
+        return "/usr/lib/ccache"
+
+    def ccache_owner(self) -> str:
+        """
+        User the build runs as, who needs to write to the compiler cache.
+        """
+        return ""
+
+    def install_ccache(self, container: dagger.Container) -> dagger.Container:
+        """
+        Install ccache into a prepared container.
+        """
+        raise NotImplementedError(f"ccache is not supported for {self.image}")
+
+    def with_ccache(self, client: dagger.Client, container: dagger.Container) -> dagger.Container:
+        """
+        Install ccache and put its wrappers first in the PATH, backed by a cache volume per image.
+        The statistics are zeroed so ccache_stats() reports this build.
+        """
+        image = re.sub(r"[^A-Za-z0-9_.-]", "-", self.image)
+        container = self.install_ccache(container)
+        kwargs = {"owner": self.ccache_owner()} if self.ccache_owner() else {}
+        return (
+            container
+            .with_mounted_cache(self.CCACHE_DIR, client.cache_volume(f"shipyard-ccache-{image}"), **kwargs)
+            .with_env_variable("CCACHE_DIR", self.CCACHE_DIR)
+            .with_env_variable("PATH", f"{self.ccache_wrappers()}:${{PATH}}", expand=True)
+            .with_exec(["ccache", "-z"])
+        )
+
+    async def ccache_stats(self, container: dagger.Container) -> str:
+        """
+        The ccache statistics of the build.
+        """
+        try:
+            return (await container.with_exec(["ccache", "-s"]).stdout()).strip()
+        except Exception as e:
+            return f"Failed to read ccache statistics: {e}"
 
     @abstractmethod
     def setup(self, container: dagger.Container) -> dagger.Container:
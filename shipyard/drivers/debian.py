@@ -2,11 +2,20 @@ from .base import DistroDriver
 import dagger
 
 class DebianDriver(DistroDriver):
+    def cache_volumes(self) -> dict:
+        return {"/var/cache/apt/archives": "apt"}
+
     def setup(self, container: dagger.Container) -> dagger.Container:
         return (
             container
             #TODO Can I pull the timezone from the local environment here?
             .with_exec(["ln", "-fs", "/usr/share/zoneinfo/America/New_York", "/etc/localtime"])
+            # The docker images delete downloaded packages, keep them in the apt cache volume
+            .with_exec([
+                "/bin/sh", "-c",
+                "rm -f /etc/apt/apt.conf.d/docker-clean; "
+                "echo 'Binary::apt::APT::Keep-Downloaded-Packages \"true\";' > /etc/apt/apt.conf.d/99shipyard-keep-cache"
+            ])
             # For EOL Debian releases (buster and older), deb.debian.org no longer hosts
             # Release files — rewrite sources to archive.debian.org before anything else.
             .with_exec([
@@ -73,11 +82,16 @@ class DebianDriver(DistroDriver):
             .with_exec(["/bin/bash", "-c", "cd */ && quilt refresh"])
         )
 
+    def install_ccache(self, container: dagger.Container) -> dagger.Container:
+        return container.with_exec(["apt-get", "install", "-qq", "-y", "ccache"])
+
     def build(self, container: dagger.Container, package: str) -> dagger.Container:
         # Build inside the source directory.
         # Since we don't know the exact name (e.g. package-version), we use shell globbing to enter it.
         # We assume there is only one directory in /tmp/build matching the pattern after apt-get source.
         
+        # debuild cleans the environment, pass the compiler cache through explicitly
+        ccache = f"--prepend-path={self.ccache_wrappers()} -eCCACHE_DIR " if self.ccache else ""
         # Env vars for skipping tests/checks
         return (
             container
@@ -85,7 +99,7 @@ class DebianDriver(DistroDriver):
             .with_env_variable("DEBUILD_DPKG_BUILDPACKAGE_OPTS", "-d")
             .with_workdir("/tmp/build")
             # We use bash to glob and enter the directory
-            .with_exec(["/bin/bash", "-c", "cd */ && debuild --no-lintian -d -uc -us -b"])
+            .with_exec(["/bin/bash", "-c", f"cd */ && debuild {ccache}--no-lintian -d -uc -us -b"])
         )
 
     def get_artifact_pattern(self, package: str) -> str:
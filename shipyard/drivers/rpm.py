@@ -3,7 +3,15 @@ import dagger
 import re
 
 class RPMDriver(DistroDriver):
+    def cache_volumes(self) -> dict:
+        return {"/var/cache/dnf": "dnf", "/var/cache/yum": "yum"}
+
     def setup(self, container: dagger.Container) -> dagger.Container:
+        # Keep downloaded packages in the cache volumes
+        container = container.with_exec([
+            "/bin/sh", "-c",
+            "for f in /etc/dnf/dnf.conf /etc/yum.conf; do [ -f $f ] && echo keepcache=1 >> $f; done; true"
+        ])
         # Rocky Linux logic
         if "rockylinux:8" in self.image:
             container = (
@@ -150,6 +158,18 @@ class RPMDriver(DistroDriver):
              
         return content
 
+    def ccache_wrappers(self) -> str:
+        return "/usr/lib64/ccache"
+
+    def install_ccache(self, container: dagger.Container) -> dagger.Container:
+        # ccache comes from EPEL on the enterprise distros. setup only enables it on Rocky,
+        # so when the enabled repos do not have it, enable EPEL (amazon-linux-extras on AL2)
+        return container.with_exec([
+            "/bin/sh", "-c",
+            "yum install -y ccache || { "
+            "(yum install -y epel-release || amazon-linux-extras install -y epel) && yum install -y ccache; }"
+        ])
+
     def build(self, container: dagger.Container, package: str) -> dagger.Container:
         return (
             container
@@ -1,69 +1,302 @@
 import sys
+import time
+import inspect
 import dagger
+import anyio
 import os
 import re
+from shipyard.cache import FileCache, cache_dir, digest, file_digest
+from shipyard.drivers.base import DistroDriver
 from shipyard.drivers.debian import DebianDriver
 from shipyard.drivers.rpm import RPMDriver
 from shipyard.drivers.arch import ArchDriver
 
-async def build_package(image: str, package: str, patch_content: str, output_dir: str = "builds", interactive: bool = False, artifacts: str = ""):
+def get_driver(image: str, ccache: bool = False):
+    """Pick the distro driver for an image"""
+    if any(x in image for x in ["debian", "ubuntu", "linuxmint", "kali"]):
+        return DebianDriver(image, ccache=ccache)
+    elif any(x in image for x in ["redhat", "centos", "rocky", "fedora", "amazonlinux"]):
+        return RPMDriver(image, ccache=ccache)
+    elif "archlinux" in image:
+        return ArchDriver(image, ccache=ccache)
+    raise ValueError(f"Unsupported image: {image}")
+
+def image_output_dir(output: str, image: str) -> str:
+    """Where the artifacts of image go: <output>/<image>, with the tag as a subdirectory"""
+    return os.path.join(output, *image.split(":"))
+
+async def build_package(image: str, package: str, patch_content: str, output_dir: str = "builds", interactive: bool = False, artifacts: str = "", cache: bool = True, incremental: bool = False, ccache: bool = False):
     async with dagger.Connection(dagger.Config(log_output=sys.stderr)) as client:
-        # Determine driver
-        if any(x in image for x in ["debian", "ubuntu", "linuxmint", "kali"]):
-            driver = DebianDriver(image)
-        elif any(x in image for x in ["redhat", "centos", "rocky", "fedora", "amazonlinux"]):
-            driver = RPMDriver(image)
-        elif "archlinux" in image:
-             driver = ArchDriver(image)
-        else:
-            raise ValueError(f"Unsupported image: {image}")
+        await _build(client, image, package, patch_content, output_dir, interactive, artifacts, cache=cache, incremental=incremental, ccache=ccache)
 
-        print(f"[*] Starting build for {package} on {image}")
+def _snapshots() -> FileCache:
+    """Prepared containers saved by incremental builds"""
+    return FileCache(cache_dir("snapshots"), max_entries=16, max_size=32 << 30, max_age=7*24*3600)
 
-        ctr = None
-        ctr_pre_build = None
+def _snapshot_key(driver, ref: str, package: str) -> str:
+    # A change to the driver changes what a prepared container looks like
+    sources = [file_digest(inspect.getfile(c)) for c in (type(driver), DistroDriver)]
+    return digest("prepared", ref, package, type(driver).__name__, *sources)
+
+async def _prepare_incremental(client: dagger.Client, driver, image: str, package: str, cache=True, prepared: dict = None) -> dagger.Container:
+    """Like _prepare, but the prepared container is saved to the host keyed by (image digest,
+    package) and imported by later builds. Those skip setup and fetching sources and
+    build-deps, leaving only apply_patch and build to run. A tag that moves to a new image
+    gets a new snapshot. Snapshots expire after a week"""
+    store = _snapshots()
+    ref = await client.container().from_(image).image_ref()
+    key = _snapshot_key(driver, ref, package)
+    if prepared is not None and key in prepared:
+        return prepared[key]
+    snapshot = store.get(key)
+    if snapshot:
+        print(f"[*] Using the prepared {package} on {image} from {snapshot}")
+        ctr = client.container().import_(client.host().file(snapshot))
+    else:
+        ctr = await _prepare(client, driver, image, package, cache=cache)
+        tmp = store.new_file(key)
         try:
-            ctr = client.container().from_(image)
-            ctr = driver.setup(ctr)
-            ctr = driver.install_build_deps(ctr, package)
-            ctr = await driver.apply_patch(ctr, patch_content, package)
-            ctr_pre_build = ctr
-            ctr = driver.build(ctr, package)
-            os.makedirs(output_dir, exist_ok=True)
-            artifact_pattern = artifacts if artifacts else driver.get_artifact_pattern(package)
-            src_dir = driver.get_artifact_dir()
-            print(f"[*] listing artifacts in {src_dir}...")
-            files = await driver.list_artifacts(ctr)
-            matches = [f for f in files if re.search(artifact_pattern, f)]
-            if not matches:
-                print(f"[!] Warning: No artifacts found matching '{artifact_pattern}'")
+            await ctr.export(tmp)
+            print(f"[*] Saved the prepared {package} on {image} to {store.commit(tmp, key)}")
+        except Exception as e:
+            os.remove(tmp)
+            print(f"[!] Could not save the prepared {package} on {image}: {e}")
+    if prepared is not None:
+        prepared[key] = ctr
+    return ctr
+
+async def _prepare(client: dagger.Client, driver, image: str, package: str, cache=True, prepared: dict = None) -> dagger.Container:
+    """The image after setup(), install_build_deps() and prepare_source(). The image is pinned to the digest
+    it resolves to, so an unchanged image gives the same steps and the engine's layer cache
+    goes straight to apply_patch. With cache, package downloads go to cache volumes so a new
+    image digest does not mean downloading everything again
+
+    prepared: containers already prepared in this session, keyed by (image digest, package)
+    """
+    ref = await client.container().from_(image).image_ref()
+    key = (ref, package)
+    if prepared is not None and key in prepared:
+        print(f"[*] Reusing the prepared {image} for {package}")
+        return prepared[key]
+    ctr = client.container().from_(ref)
+    if cache:
+        ctr = driver.with_caches(client, ctr)
+    ctr = driver.setup(ctr)
+    ctr = driver.install_build_deps(ctr, package)
+    if cache:
+        ctr = driver.without_caches(ctr)
+    ctr = driver.prepare_source(ctr, package)
+    if prepared is not None:
+        prepared[key] = ctr
+    return ctr
+
+async def _build(client: dagger.Client, image: str, package: str, patch_content: str, output_dir: str, interactive=False, artifacts="", cache=True, prepared: dict = None, incremental=False, ccache=False, stats: list = None) -> list:
+    """Build package on image with an open client and export the artifacts to output_dir.
+    With incremental (and cache) the prepared container is reused between runs. With
+    ccache, compiles go through a compiler cache and its statistics are appended to stats.
+    Returns the names of the exported artifacts"""
+    driver = get_driver(image, ccache=ccache)
+
+    print(f"[*] Starting build for {package} on {image}")
+
+    ctr = None
+    ctr_pre_build = None
+    matches = []
+    try:
+        prepare = _prepare_incremental if incremental and cache else _prepare
+        ctr = await prepare(client, driver, image, package, cache=cache, prepared=prepared)
+        if ccache:
+            ctr = driver.with_ccache(client, ctr)
+        ctr = await driver.apply_patch(ctr, patch_content, package)
+        ctr_pre_build = ctr
+        ctr = driver.build(ctr, package)
+        os.makedirs(output_dir, exist_ok=True)
+        artifact_pattern = artifacts if artifacts else driver.get_artifact_pattern(package)
+        src_dir = driver.get_artifact_dir()
+        print(f"[*] listing artifacts in {src_dir} for {package} on {image}...")
+        files = await driver.list_artifacts(ctr)
+        matches = [f for f in files if re.search(artifact_pattern, f)]
+        if ccache:
+            ccache_stats = await driver.ccache_stats(ctr)
+            print(f"[*] ccache statistics for {package} on {image}:\n{ccache_stats}")
+            if stats is not None:
+                stats.append(ccache_stats)
+        if not matches:
+            print(f"[!] Warning: No artifacts found matching '{artifact_pattern}' for {package} on {image}")
+        else:
+            print(f"[*] Found {len(matches)} artifacts matching '{artifact_pattern}'")
+            await export_artifacts(ctr, src_dir, matches, output_dir)
+
+        if interactive:
+            print("[*] Build successful. Dropping into interactive shell...")
+            await ctr.terminal().sync()
+
+    except Exception as e:
+        print(f"[!] Build failed: {e}")
+        if interactive:
+            # Use the most recent valid container state
+            target_ctr = ctr_pre_build or ctr
+            if target_ctr:
+                print("[*] Dropping into interactive shell...")
+                await target_ctr.terminal().sync()
             else:
-                print(f"[*] Found {len(matches)} artifacts matching '{artifact_pattern}'")
-                # We can copy artifacts to a clean directory inside container and export that.
-                ctr = ctr.with_exec(["mkdir", "-p", "/tmp/artifacts"])
-                ctr = ctr.with_new_file("/tmp/artifacts_list", "\n".join(matches))
-                copy_cmd = f"cd {src_dir} && tr '\\n' '\\0' < /tmp/artifacts_list | xargs -0 cp -t /tmp/artifacts/"
-                ctr = ctr.with_exec(["/bin/bash", "-c", copy_cmd])
-                await ctr.directory("/tmp/artifacts").export(output_dir)
-                
-                print(f"[+] Build complete. Artifacts exported to {output_dir}")
-                for root, dirs, files in os.walk(output_dir):
-                    for file in files:
-                        print(f"  - {file}")
-
-            if interactive:
-                print("[*] Build successful. Dropping into interactive shell...")
-                await ctr.terminal().sync()
+                print("[!] No container available to drop into.")
+        else:
+            raise e
+    return [os.path.basename(m) for m in matches]
+
+MANIFEST = "SHA256SUMS"
+
+def _read_manifest(output_dir: str) -> dict:
+    """The entries of the SHA256SUMS in output_dir as {name: sha256}"""
+    sums = {}
+    try:
+        with open(os.path.join(output_dir, MANIFEST)) as f:
+            for line in f:
+                h, _, name = line.rstrip("\n").partition("  ")
+                if name:
+                    sums[name] = h
+    except OSError:
+        pass
+    return sums
+
+def _write_manifest(output_dir: str, sums: dict):
+    """Merge sums into the SHA256SUMS of output_dir (other builds may share it)"""
+    merged = _read_manifest(output_dir)
+    merged.update(sums)
+    tmp = os.path.join(output_dir, f".{MANIFEST}.tmp")
+    with open(tmp, "w") as f:
+        for name in sorted(merged):
+            f.write(f"{merged[name]}  {name}\n")
+    os.replace(tmp, os.path.join(output_dir, MANIFEST))
+
+async def export_artifacts(ctr: dagger.Container, src_dir: str, matches: list, output_dir: str, jobs: int = 8) -> dict:
+    """Export the artifacts (relative to src_dir) into output_dir, several at a time. The
+    files are hashed in the container first and the ones already on disk with the same
+    sha256 are left alone. The hashes are recorded in output_dir/SHA256SUMS
+
+    Return: {name: sha256}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    out = await ctr.with_workdir(src_dir).with_exec(["sha256sum", "--", *matches]).stdout()
+    sums = {}
+    for line in out.splitlines():
+        h, _, p = line.partition("  ")
+        if p:
+            sums[os.path.basename(p.lstrip("*"))] = h
+    sources = {os.path.basename(m): m for m in matches}
 
+    def unchanged(name):
+        dest = os.path.join(output_dir, name)
+        return os.path.isfile(dest) and file_digest(dest) == sums.get(name)
+
+    limiter = anyio.CapacityLimiter(max(1, jobs))
+    exported, skipped = [], []
+
+    async def export(name):
+        async with limiter:
+            if await anyio.to_thread.run_sync(unchanged, name):
+                skipped.append(name)
+                return
+            await ctr.file(f"{src_dir}/{sources[name]}").export(os.path.join(output_dir, name))
+            exported.append(name)
+
+    async with anyio.create_task_group() as tg:
+        for name in sources:
+            tg.start_soon(export, name)
+    _write_manifest(output_dir, sums)
+
+    print(f"[+] Build complete. Artifacts exported to {output_dir}")
+    for name in sorted(sources):
+        print(f"  - {name}{' (unchanged)' if name in skipped else ''}")
+    return sums
+
+class BuildResult:
+    def __init__(self, image: str, package: str, output_dir: str) -> None:
+        self.image = image
+        self.package = package
+        self.output_dir = output_dir
+        self.artifacts = []
+        self.error = None
+        self.seconds = 0.0
+        self.ccache = [] # ccache -s output, when the build used ccache
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        status = "PASS" if self.ok else "FAIL"
+        detail = f"{len(self.artifacts)} artifacts in {self.output_dir}" if self.ok else self.error
+        hits = [l.strip() for s in self.ccache for l in s.splitlines() if "hit" in l.lower()]
+        if hits:
+            detail = f"{detail} (ccache {hits[0]})"
+        return f"{status} {self.package} on {self.image} ({self.seconds:.0f}s): {detail}"
+
+async def build_matrix(builds: list, output: str = "builds", artifacts: str = "", jobs: int = 4, cache: bool = True, incremental: bool = False, ccache: bool = False) -> list:
+    """Build every (image, package, patch_content) in builds over a single Dagger
+    connection, at most jobs at a time. A failed build does not stop the others.
+    Artifacts of each image go to <output>/<image>. Builds of the same package on the
+    same image share the prepared container
+
+    patch_content can also be an awaitable (e.g. AsyncGitMgr.export()) that is awaited
+    once for every build that shares it. They all start right away, so the patches of
+    later builds are exported while the earlier ones compile
+
+    Return: [BuildResult] in the order of builds
+    """
+    results = [BuildResult(image, package, image_output_dir(output, image)) for image, package, _ in builds]
+    limiter = anyio.CapacityLimiter(max(1, jobs))
+    prepared = {}
+    # awaitable patch_content -> [done event, patch or exception]. Keyed by the awaitable
+    # itself, so it stays alive and a new one can never be mistaken for it
+    exported = {}
+
+    async def patch_of(patch_content) -> str:
+        if isinstance(patch_content, str):
+            return patch_content
+        slot = exported.get(patch_content)
+        if slot is None:
+            slot = exported[patch_content] = [anyio.Event(), None]
+            try:
+                slot[1] = await patch_content
+            except Exception as e:
+                slot[1] = e
+            slot[0].set()
+        await slot[0].wait()
+        if isinstance(slot[1], Exception):
+            raise slot[1]
+        return slot[1]
+
+    def error(e: Exception) -> str:
+        return str(e).strip().splitlines()[-1] if str(e).strip() else type(e).__name__
+
+    async def run(res: BuildResult, patch_content):
+        try:
+            patch_content = await patch_of(patch_content)
         except Exception as e:
-            print(f"[!] Build failed: {e}")
-            if interactive:
-                # Use the most recent valid container state
-                target_ctr = ctr_pre_build or ctr
-                if target_ctr:
-                    print("[*] Dropping into interactive shell...")
-                    await target_ctr.terminal().sync()
-                else:
-                    print("[!] No container available to drop into.")
-            else:
-                raise e
+            res.error = f"export failed: {error(e)}"
+            return
+        async with limiter:
+            start = time.monotonic()
+            try:
+                res.artifacts = await _build(client, res.image, res.package, patch_content, res.output_dir, artifacts=artifacts, cache=cache, prepared=prepared, incremental=incremental, ccache=ccache, stats=res.ccache)
+            except Exception as e:
+                res.error = error(e)
+            res.seconds = time.monotonic() - start
+
+    async with dagger.Connection(dagger.Config(log_output=sys.stderr)) as client:
+        async with anyio.create_task_group() as tg:
+            for res, (_, _, patch_content) in zip(results, builds):
+                tg.start_soon(run, res, patch_content)
+
+    print_summary(results)
+    return results
+
+def print_summary(results: list):
+    """Print one line per build and the totals"""
+    print(f"\n{'='*67}")
+    for res in results:
+        print(f"[{'+' if res.ok else '!'}] {res}")
+    failed = sum(1 for r in results if not r.ok)
+    print(f"[*] {len(results) - failed}/{len(results)} builds passed")
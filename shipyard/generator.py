@@ -22,6 +22,12 @@ class Shipfile:
     # Test using git tag -l 'PATTERN'
     VersionTags = "*"
 
+    # For huge repos: "blobless" or "treeless" partial clones, and only fetching the VersionTags
+    # CloneFilter = "blobless"
+    # FetchTagsOnly = True
+    # Only check out the files that the patches and CodePatches touch
+    # SparseCheckout = True
+
     @staticmethod
     def is_version_ignored(version) -> bool:
         """Return True if we want to skip this version"""
@@ -59,7 +65,7 @@ def new_project(directory, url, name=""):
     with open(os.path.join(directory, "shipfile.py"), "w") as of:
         of.write(template.format(url=url, name=name))
     with open(os.path.join(directory, ".gitignore"), "w") as of:
-        of.write("sources/*\n*.pyc\n")
+        of.write("sources/*\n*.pyc\n.shipyard/\n")
     with open(os.path.join(directory, "patches", ".gitkeep"), "w") as of:
         of.write("Patches go here")
     
@@ -1,13 +1,32 @@
 # Handle git repositories, extract all the tags
 # (versions) and check them out accordingly
 import subprocess
+import tempfile
+import shutil
+import queue
+import copy
 import os
+import re
 
 from typing import List
 
 from shipyard.sources import SourceManager, SourceProgram
 from shipyard.patch import PatchFile
-from shipyard import Version
+from shipyard.version import VersionIndex
+from shipyard.catalog import VersionCatalog
+
+def _decode(data: bytes):
+    """Return data as a string if it is utf-8, otherwise leave it as bytes"""
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data
+
+# Shorthands for SourceProgram.CloneFilter
+CLONE_FILTERS = {
+    "blobless": "blob:none",
+    "treeless": "tree:0",
+}
 
 class GitMgr(SourceManager):
     def __init__(self, repo: SourceProgram) -> None:
@@ -16,27 +35,92 @@ class GitMgr(SourceManager):
         """
         self.r = repo
         repo.Directory = repo.resolve_source_directory()
+        # Paths changed since the last reset. None means we dont know, so reset cleans everything
+        self._dirty = None
+        # The paths sparse-checkout is set to, None for the full tree and False if we dont know
+        self._sparse = False
+        self._catalog: VersionCatalog = None
     
     def prepare(self):
         """Ensure we have the source code when we need it"""
         if not os.path.exists(self.r.Directory):
             print(f"[*] Cloning {self.r.Url} {self.r.Directory}")
-            res = subprocess.run(f"git clone {self.r.Url} {self.r.Directory}", shell=True, encoding="utf-8")
-            if res.returncode != 0:
-                raise ValueError(res.stderr)
-    
+            for args, cwd in self._clone_commands():
+                res = subprocess.run(args, stderr=subprocess.PIPE, cwd=cwd, encoding="utf-8")
+                if res.returncode != 0:
+                    raise ValueError(res.stderr)
+            if self.r.FetchTagsOnly:
+                versions = self.versions()
+                if versions and versions[-1] != "HEAD":
+                    self.checkout(versions[-1])
+
+    def _tag_refspec(self) -> str:
+        """A refspec for the version tags. Refspecs only know a single *, so other
+        patterns fetch every tag"""
+        pattern = self.r.VersionTags
+        if pattern.count("*") > 1 or any(c in pattern for c in "?[]\\"):
+            pattern = "*"
+        return f"+refs/tags/{pattern}:refs/tags/{pattern}"
+
+    def _clone_commands(self) -> list:
+        """The git commands (args, cwd) that clone the source. FetchTagsOnly clones are an
+        empty repo whose origin fetches nothing but refs/tags/<VersionTags>, the newest
+        version gets checked out after"""
+        clone_filter = CLONE_FILTERS.get(self.r.CloneFilter, self.r.CloneFilter)
+        filter_args = [f"--filter={clone_filter}"] if clone_filter else []
+        if not self.r.FetchTagsOnly:
+            return [(["git", "clone"] + filter_args + [self.r.Url, self.r.Directory], None)]
+        cmds = [
+            ["git", "remote", "add", "origin", self.r.Url],
+            ["git", "config", "remote.origin.fetch", self._tag_refspec()],
+            ["git", "config", "remote.origin.tagOpt", "--no-tags"],
+        ]
+        if clone_filter:
+            cmds += [
+                ["git", "config", "remote.origin.promisor", "true"],
+                ["git", "config", "remote.origin.partialclonefilter", clone_filter],
+            ]
+        cmds.append(["git", "fetch", "origin"] + filter_args)
+        return [(["git", "init", "-q", self.r.Directory], None)] + [(args, self.r.Directory) for args in cmds]
+
+    def _list_tags(self) -> List[str]:
+        res = subprocess.run(
+            ["git", "for-each-ref", "--format=%(refname:strip=2)", "refs/tags"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.r.Directory,
+            encoding="utf-8"
+        )
+        if res.returncode != 0:
+            raise ValueError(res.stderr)
+        return res.stdout.splitlines()
+
+    def fetch(self) -> List[str]:
+        """Fetch new tags from origin (only the version tags for FetchTagsOnly clones,
+        which have the refspec configured). Returns the tags that are new"""
+        self.prepare()
+        before = set(self._list_tags())
+        args = ["git", "fetch", "origin"]
+        if not self.r.FetchTagsOnly:
+            args.append("--tags")
+        res = subprocess.run(
+            args,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.r.Directory,
+            encoding="utf-8"
+        )
+        if res.returncode != 0:
+            raise ValueError(res.stderr)
+        return [t for t in self._list_tags() if t not in before]
+
     def read(self, path: str):
         self.prepare()
         fpath = os.path.join(self.r.Directory, path)
         with open(fpath, "rb") as f:
-            data = f.read()
-        try:
-            return data.decode("utf-8")
-        except UnicodeDecodeError:
-            return data
+            return _decode(f.read())
 
     def write(self, path: str, contents) -> None:
         self.prepare()
+        self.track([path])
         fpath = os.path.join(self.r.Directory, path)
         os.makedirs(os.path.dirname(fpath), exist_ok=True)
         if isinstance(contents, bytes):
@@ -46,59 +130,84 @@ class GitMgr(SourceManager):
             with open(fpath, "w", encoding="utf-8") as f:
                 f.write(contents)
 
-    def list_files(self) -> List[str]:
+    def list_files(self, version=None, untracked=False) -> List[str]:
+        """List the files git tracks in the working tree, or in the tree of version.
+        untracked adds the files in the working tree that git does not know about and
+        that are not ignored"""
         self.prepare()
+        if version is not None:
+            args = ["git", "ls-tree", "-r", "-z", "--name-only", self._rev(version)]
+        else:
+            args = ["git", "ls-files", "-z", "--cached"]
+        files = self._git_files(args)
+        if untracked and version is None:
+            files += self._git_files(["git", "ls-files", "-z", "--others", "--exclude-standard"])
+        return files
+
+    def _git_files(self, args) -> List[str]:
         res = subprocess.run(
-            ["git", "ls-files"],
+            args,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             cwd=self.r.Directory,
-            encoding="utf-8"
+            encoding="utf-8", errors="surrogateescape"
         )
         if res.returncode != 0:
             raise ValueError(res.stderr)
-        return res.stdout.splitlines()
+        return [f for f in res.stdout.split("\0") if f]
 
-    def version(self) -> str:
-        """Return the current version"""
+    def tree_id(self, version=None) -> str:
+        """Return the id of the git tree for version (default HEAD) or None"""
+        if version is not None and self.catalog().tree(version):
+            return self.catalog().tree(version)
         self.prepare()
         res = subprocess.run(
-            ["git", "describe", "--tags"],
+            ["git", "rev-parse", "--verify", "-q", f"{self._rev(version)}^{{tree}}"],
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             cwd=self.r.Directory,
             encoding="utf-8"
         )
+        if res.returncode != 0:
+            return None
         return res.stdout.strip()
 
-    def versions(self) -> List[str]:
+    def version(self) -> str:
+        """Return the current version"""
         self.prepare()
         res = subprocess.run(
-            ["git", "--no-pager", "tag", "-l", self.r.VersionTags],
+            ["git", "describe", "--tags"],
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             cwd=self.r.Directory,
             encoding="utf-8"
         )
-        if res.returncode != 0:
-            raise ValueError(res.stderr)
-        out = res.stdout
-        versions = []
-        for tag in out.split():
-            version = Version(self.r.tag_to_version(tag))
-            if version and not self.r.is_version_ignored(version):
-                versions.append(version)
-        if not versions:
-            versions = ["HEAD"]
-        return sorted(versions)
+        return res.stdout.strip()
+
+    def catalog(self) -> VersionCatalog:
+        """The version catalog of the repo, shared with our worktrees"""
+        self.prepare()
+        if self._catalog is None:
+            self._catalog = VersionCatalog(self.r, self.r.Directory)
+        return self._catalog
+
+    def versions(self) -> VersionIndex:
+        return self.catalog().versions()
+
+    def tag(self, version) -> str:
+        return self.catalog().tag(version)
+
+    def _rev(self, version=None) -> str:
+        """The revision of version: its tag, or HEAD for no version and for the HEAD that
+        versions() lists when there are no version tags"""
+        if version is None or (str(version) == "HEAD" and not self.catalog().commit(version)):
+            return "HEAD"
+        return f"tags/{self.tag(version)}"
 
     def checkout(self, version) -> None:
         """Make sure we have the correct version of the code sitting at
         self.r.Directory after this function is called. In our case its a git-checkout
         in other scenarios it might be a wget/etc"""
         self.prepare()
-        tag = self.r.version_to_tag(version)
-        
         res = subprocess.run(
-            f"git checkout tags/{tag}",
-            shell=True,
+            ["git", "checkout", self._rev(version)],
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             cwd=self.r.Directory,
             encoding="utf-8"
@@ -110,8 +219,11 @@ class GitMgr(SourceManager):
         #rel = os.path.relpath(patch.Filename, self.r.Directory)
         self.prepare()
         args = ["git", "apply", "-v", "--recount"]
+        paths = list(patch.paths)
         if reject:
             args.insert(2, "--reject")
+            paths += [p + ".rej" for p in paths]
+        self.track(paths)
         res = subprocess.run(
             args,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
@@ -126,12 +238,42 @@ class GitMgr(SourceManager):
             raise ValueError(res.stderr)
         return True
     
+    def check(self, version, patches: List[PatchFile]) -> List[str]:
+        """Check patches against the tree of a version without a working tree. The tree is
+        read into a scratch index and each patch is applied to that index, so later
+        patches see the changes from earlier ones just like a real apply would"""
+        self.prepare()
+        rev = self._rev(version)
+        with tempfile.TemporaryDirectory(prefix="shipyard-index-") as td:
+            env = dict(os.environ, GIT_INDEX_FILE=os.path.join(td, "index"))
+            res = subprocess.run(
+                ["git", "read-tree", rev],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=self.r.Directory,
+                encoding="utf-8",
+                env=env
+            )
+            if res.returncode != 0:
+                raise ValueError(res.stderr)
+            errors = []
+            for patch in patches:
+                res = subprocess.run(
+                    ["git", "apply", "--cached", "--recount"],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    cwd=self.r.Directory,
+                    input=patch.dump(),
+                    encoding="utf-8",
+                    env=env
+                )
+                errors.append((res.stderr.strip() or "patch does not apply") if res.returncode != 0 else None)
+        return errors
+
     def refresh(self, patch: PatchFile = None):
         """Refresh a patch file and return the results"""
         self.prepare()
         args = ["git", "--no-pager", "diff", ]
         if patch:
-            args.append(patch.Index)
+            args += ["--"] + patch.paths
         res = subprocess.run(
             args,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
@@ -143,11 +285,73 @@ class GitMgr(SourceManager):
         
         return res.stdout
 
-    def reset(self):
+    def track(self, paths: List[str] = None):
+        """Record paths (relative to the repo) that were changed so the next reset only
+        needs to restore those. Without paths, the next reset cleans the whole tree"""
+        if paths is None:
+            self._dirty = None
+        elif self._dirty is not None:
+            for p in paths:
+                p = os.path.normpath(p)
+                if not p.startswith("..") and not os.path.isabs(p):
+                    self._dirty.add(p)
+
+    def reset(self, full=False):
+        """Undo all changes in the tree. Only the tracked paths are restored unless
+        full is set or we do not know what was changed"""
         self.prepare()
+        if full or self._dirty is None:
+            return self._reset_all()
+        if not self._dirty:
+            return
+        paths = sorted(self._dirty)
+        try:
+            self._reset_paths(paths)
+        except (ValueError, OSError) as e:
+            print(f"[!] Failed to reset {len(paths)} changed files, cleaning the whole tree: {e}")
+            return self._reset_all()
+        self._dirty = set()
+
+    def _reset_paths(self, paths: List[str]):
+        """Restore the given paths to HEAD and delete any that git does not know about"""
+        res = subprocess.run(
+            ["git", "--literal-pathspecs", "ls-files", "-z", "--"] + paths,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.r.Directory,
+            encoding="utf-8"
+        )
+        if res.returncode != 0:
+            raise ValueError(res.stderr)
+        tracked = set(res.stdout.split("\0")) - {""}
+        if tracked:
+            res = subprocess.run(
+                ["git", "--literal-pathspecs", "checkout", "--"] + sorted(tracked),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=self.r.Directory,
+                encoding="utf-8"
+            )
+            if res.returncode != 0:
+                raise ValueError(res.stderr)
+        for p in paths:
+            if p in tracked:
+                continue
+            fpath = os.path.join(self.r.Directory, p)
+            if os.path.isdir(fpath) and not os.path.islink(fpath):
+                shutil.rmtree(fpath)
+            elif os.path.lexists(fpath):
+                os.remove(fpath)
+            # Clean up any directories the patch created
+            d = os.path.dirname(p)
+            while d:
+                try:
+                    os.rmdir(os.path.join(self.r.Directory, d))
+                except OSError:
+                    break
+                d = os.path.dirname(d)
+
+    def _reset_all(self):
         res = subprocess.run(
-            "git checkout .",
-            shell=True,
+            ["git", "checkout", "."],
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             cwd=self.r.Directory,
             encoding="utf-8"
@@ -156,11 +360,132 @@ class GitMgr(SourceManager):
             raise ValueError(res.stderr)
     
         res = subprocess.run(
-            "git clean -fdx",
-            shell=True,
+            ["git", "clean", "-fdx"],
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             cwd=self.r.Directory,
             encoding="utf-8"
         )
         if res.returncode != 0:
-            raise ValueError(res.stderr)
\ No newline at end of file
+            raise ValueError(res.stderr)
+        self._dirty = set()
+
+    def sparse(self, paths: List[str] = None) -> None:
+        """Restrict the working tree to paths with git sparse-checkout, so checkouts only
+        write those files. None checks out the full tree again"""
+        self.prepare()
+        if paths is not None:
+            paths = sorted(set(paths))
+        if paths == self._sparse:
+            return
+        if paths is None:
+            args, patterns = ["git", "sparse-checkout", "disable"], None
+        else:
+            # Anchored non-cone patterns match exactly these files
+            args = ["git", "sparse-checkout", "set", "--no-cone", "--stdin"]
+            patterns = "".join("/" + re.sub(r"([\\*?\[])", r"\\\1", p) + "\n" for p in paths)
+        res = subprocess.run(
+            args,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.r.Directory,
+            input=patterns,
+            encoding="utf-8"
+        )
+        if res.returncode != 0:
+            raise ValueError(res.stderr)
+        self._sparse = paths
+
+    def worktree(self, directory: str, version) -> "GitMgr":
+        """Add a detached worktree of this repository at directory, checked out to version.
+        The returned manager works on the worktree and shares the object store with us"""
+        self.prepare()
+        res = subprocess.run(
+            ["git", "worktree", "add", "--detach", os.path.abspath(directory), self._rev(version)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.r.Directory,
+            encoding="utf-8"
+        )
+        if res.returncode != 0:
+            raise ValueError(res.stderr)
+        r = copy.copy(self.r)
+        r.source_directory = directory
+        wt = type(self)(r)
+        wt._dirty = set() # Fresh checkout
+        wt._catalog = self._catalog # Worktrees share the refs
+        if self._sparse:
+            # New worktrees copy our sparse-checkout, but they check out other versions
+            wt.sparse(None)
+        return wt
+
+    def remove_worktree(self, mgr: "GitMgr"):
+        """Remove a worktree created with worktree()"""
+        res = subprocess.run(
+            ["git", "worktree", "remove", "--force", os.path.abspath(mgr.r.Directory)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.r.Directory,
+            encoding="utf-8"
+        )
+        if res.returncode != 0:
+            raise ValueError(res.stderr)
+
+    def worktrees(self, size: int) -> "WorktreePool":
+        """Return a pool of size worktrees to run version checks in parallel. The main
+        clone is not touched while the pool is in use"""
+        return WorktreePool(self, size)
+
+
+class WorktreePool:
+    """A pool of git worktrees backed by a single clone. Each worker borrows a worktree,
+    checks out the version it needs and hands it back when done
+
+        with mgr.worktrees(4) as pool:
+            ok = pool.run(func, version) # func(source, version)
+    """
+    def __init__(self, mgr: GitMgr, size: int) -> None:
+        self.mgr = mgr
+        self.size = max(1, size)
+        self._dir = ""
+        self._trees: List[GitMgr] = []
+        self._free = queue.Queue()
+
+    def __enter__(self):
+        self._dir = tempfile.mkdtemp(prefix=f"shipyard-{self.mgr.r.Name}-")
+        version = self.mgr.versions()[0]
+        try:
+            for i in range(self.size):
+                wt = self.mgr.worktree(os.path.join(self._dir, str(i)), version)
+                self._trees.append(wt)
+                self._free.put(wt)
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for wt in self._trees:
+            wt.close()
+            try:
+                self.mgr.remove_worktree(wt)
+            except ValueError as e:
+                print(f"[!] Failed to remove worktree {wt.r.Directory}: {e}")
+        self._trees = []
+        if self._dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = ""
+        subprocess.run(
+            ["git", "worktree", "prune"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.mgr.r.Directory,
+        )
+
+    def run(self, func, version, *args):
+        """Check out version in a free worktree and call func(source, version, *args) there"""
+        wt = self._free.get()
+        try:
+            wt.reset()
+            wt.checkout(version)
+            return func(wt, version, *args)
+        finally:
+            self._free.put(wt)
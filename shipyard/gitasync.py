@@ -0,0 +1,128 @@
+# A GitMgr for asyncio code. git runs through asyncio subprocesses, so work on the
+# source (checkout, apply, refresh) can overlap other async work like Dagger builds
+import asyncio
+import os
+
+from typing import List
+
+from shipyard.git import GitMgr
+from shipyard.sources import SourceProgram
+from shipyard.patch import PatchFile
+from shipyard.version import VersionIndex
+
+class AsyncGitMgr:
+    """The git operations of GitMgr as coroutines. Anything that does not run git (tags,
+    the version catalog, clone commands) comes from a GitMgr on the same repo.
+
+    There is a single working tree, so export() holds a lock while it uses it:
+
+        src = AsyncGitMgr(patches.infoObject)
+        patch = await src.export(version, patches.versions[version])
+    """
+    def __init__(self, repo: SourceProgram) -> None:
+        self.git = GitMgr(repo)
+        self.r = repo
+        self._prepared = False
+        # Created on first use so they belong to the running loop
+        self._prepare_lock: asyncio.Lock = None
+        self._tree_lock: asyncio.Lock = None
+
+    async def _run(self, args, input: str = None, cwd=None) -> "tuple[int, str, str]":
+        """Run a command and return (returncode, stdout, stderr)"""
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            cwd=cwd or self.r.Directory,
+        )
+        out, err = await proc.communicate(input.encode("utf-8") if input is not None else None)
+        return proc.returncode, out.decode("utf-8", "surrogateescape"), err.decode("utf-8", "replace")
+
+    async def _git(self, args, input: str = None, cwd=None) -> str:
+        code, out, err = await self._run(args, input=input, cwd=cwd)
+        if code != 0:
+            raise ValueError(err)
+        return out
+
+    async def prepare(self):
+        """Ensure we have the source code when we need it"""
+        if self._prepared:
+            return
+        if self._prepare_lock is None:
+            self._prepare_lock = asyncio.Lock()
+        async with self._prepare_lock:
+            if self._prepared:
+                return
+            cloned = False
+            if not os.path.exists(self.r.Directory):
+                print(f"[*] Cloning {self.r.Url} {self.r.Directory}")
+                for args, cwd in self.git._clone_commands():
+                    await self._git(args, cwd=cwd or ".")
+                cloned = True
+            self._prepared = True
+        if cloned and self.r.FetchTagsOnly:
+            versions = await self.versions()
+            if versions and versions[-1] != "HEAD":
+                await self.checkout(versions[-1])
+
+    async def versions(self) -> VersionIndex:
+        """The versions from the catalog. Rebuilding it is left to a worker thread"""
+        await self.prepare()
+        return await asyncio.get_running_loop().run_in_executor(None, self.git.versions)
+
+    def tag(self, version) -> str:
+        return self.git.tag(version)
+
+    async def checkout(self, version) -> None:
+        await self.prepare()
+        await self._git(["git", "checkout", self.git._rev(version)])
+
+    async def apply(self, patch: PatchFile, reject=True, check=False) -> bool:
+        await self.prepare()
+        args = ["git", "apply", "-v", "--recount"]
+        paths = list(patch.paths)
+        if reject:
+            args.insert(2, "--reject")
+            paths += [p + ".rej" for p in paths]
+        # The tree is shared with self.git, its next reset has to know what we changed
+        self.git.track(paths)
+        code, _, err = await self._run(args, input=patch.dump())
+        if code != 0:
+            if check:
+                return False
+            raise ValueError(err)
+        return True
+
+    async def refresh(self, patch: PatchFile = None) -> str:
+        """The diff of the working tree (limited to the paths of patch)"""
+        await self.prepare()
+        args = ["git", "--no-pager", "diff"]
+        if patch:
+            args += ["--"] + patch.paths
+        return await self._git(args)
+
+    async def reset(self) -> None:
+        """Undo all changes in the tree"""
+        await self.prepare()
+        await self._git(["git", "checkout", "."])
+        await self._git(["git", "clean", "-fdx"])
+        self.git._dirty = set()
+
+    async def export(self, version, patches: List[PatchFile]) -> str:
+        """Apply the patchfiles to version and return the combined patch, like
+        Patches.export. CodePatches and the shipfile hooks are not run, use
+        Patches.export (in a thread) for those"""
+        if self._tree_lock is None:
+            self._tree_lock = asyncio.Lock()
+        async with self._tree_lock:
+            await self.reset()
+            await self.checkout(version)
+            try:
+                for patch in sorted(patches, key=lambda p: p.Name):
+                    await self.apply(patch, reject=False)
+                new_patch = f"{self.r.Name} {version}\n" + await self.refresh()
+            finally:
+                await self.reset()
+        for k, v in self.r.Variables.items():
+            new_patch = new_patch.replace(k, v)
+        return new_patch
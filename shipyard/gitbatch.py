@@ -0,0 +1,150 @@
+# A GitMgr that keeps git state in process. Objects are read through a single
+# long running `git cat-file --batch` instead of forking git for every call
+import subprocess
+import threading
+
+from typing import List
+
+from shipyard.git import GitMgr, _decode
+from shipyard.sources import SourceProgram
+from shipyard.patch import PatchFile
+from shipyard.unidiff import apply_patch, UnsupportedPatch
+
+class CatFile:
+    """A long running `git cat-file --batch` process for reading objects by name"""
+    def __init__(self, directory: str) -> None:
+        self.proc = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            cwd=directory,
+        )
+        self.lock = threading.Lock()
+
+    def get(self, rev: str) -> "tuple[str, str, bytes]":
+        """Return (oid, type, data) for rev or None if it does not exist"""
+        with self.lock:
+            self.proc.stdin.write(rev.encode("utf-8") + b"\n")
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().rstrip(b"\n")
+            # "<rev> missing" or "<rev> ambiguous", where rev may have spaces in it
+            if header.endswith((b" missing", b" ambiguous")):
+                return None
+            oid, typ, size = header.split(b" ")
+            data = self.proc.stdout.read(int(size))
+            self.proc.stdout.read(1) # Trailing newline
+        return oid.decode(), typ.decode(), data
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
+class BatchGitMgr(GitMgr):
+    """Same as GitMgr, but tags, file listings and reads of other versions are served
+    from a long running cat-file process and cached, so they do not cost a fork each.
+    Operations that change the working tree (apply, checkout, reset) still call git"""
+    def __init__(self, repo: SourceProgram) -> None:
+        super().__init__(repo)
+        self._prepared = False
+        self._cat: CatFile = None
+        self._cat_lock = threading.Lock() # Worker threads may all ask for the first object
+        self._trees = {} # tree -> [files]
+
+    def prepare(self):
+        if not self._prepared:
+            super().prepare()
+            self._prepared = True
+
+    def close(self):
+        if self._cat:
+            self._cat.close()
+            self._cat = None
+
+    def __del__(self):
+        self.close()
+
+    def _object(self, rev: str):
+        self.prepare()
+        if not self._cat:
+            with self._cat_lock:
+                if not self._cat:
+                    self._cat = CatFile(self.r.Directory)
+        return self._cat.get(rev)
+
+    def version(self) -> str:
+        head = self._object("HEAD")
+        if head:
+            for tag, commit in self.catalog().tags().items():
+                if commit == head[0]:
+                    return tag
+        return super().version()
+
+    def read(self, path: str, version=None):
+        """Read a file from the working tree, or straight from the git objects of version"""
+        if version is None:
+            return super().read(path)
+        obj = self._object(f"{self._rev(version)}:{path}")
+        if not obj or obj[1] != "blob":
+            raise FileNotFoundError(f"{path} not found in {version}")
+        return _decode(obj[2])
+
+    def check(self, version, patches: List[PatchFile]) -> List[str]:
+        """Check patches against a version entirely in memory. Files are read from the
+        git objects of version and the patches are applied in order on top of each
+        other. Falls back to git for patches the diff engine cannot handle"""
+        def read(path):
+            obj = self._object(f"{self._rev(version)}:{path}")
+            if not obj or obj[1] != "blob":
+                return None
+            return _decode(obj[2])
+
+        files = {}
+        errors = []
+        for patch in patches:
+            try:
+                res = apply_patch(patch, read, files=files)
+            except UnsupportedPatch:
+                return super().check(version, patches)
+            if res.ok:
+                files.update(res.files)
+                errors.append(None)
+            else:
+                errors.append(res.report() or "patch does not apply")
+        return errors
+
+    def tree_id(self, version=None) -> str:
+        if version is not None and self.catalog().tree(version):
+            return self.catalog().tree(version)
+        tree = self._object(f"{self._rev(version)}^{{tree}}")
+        return tree[0] if tree else None
+
+    def list_files(self, version=None, untracked=False) -> List[str]:
+        """List the files in the tree of version (default HEAD). Listings are cached per tree"""
+        tree = self.tree_id(version)
+        if not tree:
+            raise ValueError(f"Cannot find the tree for {self._rev(version)}")
+        if tree not in self._trees:
+            files = []
+            self._walk_tree(tree, "", files)
+            self._trees[tree] = sorted(files)
+        files = list(self._trees[tree])
+        if untracked and version is None:
+            files += self._git_files(["git", "ls-files", "-z", "--others", "--exclude-standard"])
+        return files
+
+    def _walk_tree(self, oid: str, prefix: str, files: list):
+        """Parse a raw tree object ('<mode> <name>\\0<oid>' entries) and recurse into subtrees"""
+        data = self._object(oid)[2]
+        oidlen = len(oid) // 2
+        i = 0
+        while i < len(data):
+            sp = data.index(b" ", i)
+            nul = data.index(b"\0", sp)
+            mode = data[i:sp]
+            name = prefix + data[sp+1:nul].decode("utf-8", "surrogateescape")
+            i = nul + 1 + oidlen
+            if mode == b"40000":
+                self._walk_tree(data[nul+1:i].hex(), name + "/", files)
+            else:
+                files.append(name)
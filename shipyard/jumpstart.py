@@ -1,14 +1,22 @@
 import os
 import re
+import stat
 import shutil
+import hashlib
+import tarfile
+import zipfile
 import subprocess
-import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from shipyard.version import Version
+from shipyard.cache import Cache, FileCache, cache_dir, digest
 
-def jumpstart(dest: str, urls: List[str]):
-    """Make sure all the URLs are downloaded into the git repo and tagged properly"""
+def jumpstart(dest: str, urls: List[str], jobs=4):
+    """Make sure all the URLs are downloaded into the git repo and tagged properly
+
+    jobs: number of archives to download at once. They are still committed in version order
+    """
     if not os.path.isdir(dest):
         os.makedirs(dest, exist_ok=True)
     # can be run several times
@@ -26,22 +34,26 @@ def jumpstart(dest: str, urls: List[str]):
         raise ValueError(res.stderr)
 
     versions = res.stdout.split()
-    for url, version, fmt in extensions(urls):
-        if version in versions:
-            continue # Skip ones we already have
-        download_version(url, version, fmt, dest)
-
-def commit(dest, msg, version=None):
-    r = subprocess.run('git add -Av', shell=True, cwd=dest, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8")
-    if r.returncode != 0:
-        raise ValueError("git-add: "+r.stderr+r.stdout)
-    r = subprocess.run(f'git commit -m "{msg}"', shell=True, cwd=dest, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8")
-    if r.returncode != 0:
-        raise ValueError("git-commit: "+r.stderr+r.stdout)
-    if version:
-        r = subprocess.run(['git', "tag", "-a", version, "-m", msg], cwd=dest, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8")
-        if r.returncode != 0:
-            raise ValueError("git-tag: "+r.stderr+r.stdout)
+    # Skip ones we already have
+    todo = [(url, version, fmt) for url, version, fmt in extensions(urls) if version not in versions]
+    if not todo:
+        return
+    with ThreadPoolExecutor(max(1, jobs)) as ex, FastImport(dest) as fi:
+        # Results are taken in the order they were submitted, so each version is committed
+        # once it and all the versions before it are downloaded
+        archives = [ex.submit(download, url) for url, _, _ in todo]
+        for (url, version, fmt), archive in zip(todo, archives):
+            try:
+                archive = archive.result()
+                print(f"[*] Importing '{version}' ({fmt}) from {url}")
+                fi.add_version(archive, url, str(version), fmt)
+            except Exception as e:
+                print(f"[!] Failed to import '{version}' from {url}: {e}")
+                if fi.imported:
+                    print(f"[*] Kept the {len(fi.imported)} versions imported before it")
+                for a in archives:
+                    a.cancel()
+                raise
 
 def extensions(urls) -> List[tuple]:
     """Get the version, and type from each url
@@ -74,49 +86,224 @@ def select_format(url: str) -> (str, str):
     return None, None
 
 
-def download_version(url: str, version: str, fmt: str, dest: str):
+def _downloads() -> FileCache:
+    """Downloaded archives, named by their sha256"""
+    return FileCache(cache_dir("downloads"), suffix=".archive", max_entries=1000, max_size=8 << 30, max_age=90*24*3600)
+
+def download(url: str, chunk_size=1 << 20) -> str:
+    """Download url into the archive cache and return its path. Archives are stored by
+    their sha256, with a map from each url to the hash. A download that was cut off is
+    resumed on the next run when the server supports ranges"""
     import requests
-    """A new release does a few things.
-    1. delete all files that dont start with .git
-    2. downloads and extract contents into the git
-    3. Commit the stuff, tag it
-    """
-    # Check if we have unstaged changes, if so, add them to a commit
-    r = subprocess.run("git diff", cwd=dest, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if len(r.stdout.splitlines()) > 0:
-        print(f"[!] Unstaged changes exist in {dest}. Refusing to delete")
-        print(r.stdout)
-        exit(1)
-
-    for f in os.listdir(dest):
-        if not f.startswith(".git"):
-            f = os.path.join(dest, f)
-            if os.path.isfile(f):
-                os.remove(f)
-            elif os.path.isdir(f):
-                shutil.rmtree(f)
-    
-    print(f"[*] Downloading '{version}' ({fmt}) from {url}")
-    with tempfile.NamedTemporaryFile() as of:
-        res = requests.get(url)
-        if res.status_code < 200 or res.status_code >= 300:
+    store = _downloads()
+    urls = Cache(cache_dir("downloads", "urls"))
+    key = digest("url", url)
+    known = urls.get(key)
+    if known:
+        archive = store.get(known["sha256"])
+        if archive:
+            print(f"[*] Using cached {url}")
+            return archive
+
+    partial = os.path.join(cache_dir("downloads", "partial"), key + ".part")
+    h = hashlib.sha256()
+    offset = 0
+    headers = {}
+    if os.path.exists(partial):
+        offset = os.path.getsize(partial)
+        headers["Range"] = f"bytes={offset}-"
+    with requests.get(url, stream=True, headers=headers, timeout=60) as res:
+        if res.status_code == 416: # Already have all of it
+            res.close()
+        elif res.status_code < 200 or res.status_code >= 300:
             print(f"[!] Bad result {res.status_code} {res.reason}")
-            print(res.content)
             raise ValueError(f"error downloading '{url}': {res.status_code}")
-        with open(of.name, "wb") as f:
-            f.write(res.content)
-        # Unzip the contents into the directory
-        # Determine if all the files are stored in a sub-directory, if they are
-        # move them out of the sub-dir
-        with tempfile.TemporaryDirectory() as td:
-            shutil.unpack_archive(of.name, td, fmt)
-            src = td
-            # Check if there is just a folder inside
-            subs = os.listdir(td)
-            if len(subs) == 1:
-                src = os.path.join(src, subs[0])
-            shutil.copytree(src, dest, dirs_exist_ok=True)
-    
-    # Make a commit here
-    commit(dest, url, version)
-    return
\ No newline at end of file
+        if res.status_code != 206 and res.status_code != 416:
+            offset = 0 # The server sent everything again
+        if offset:
+            print(f"[*] Resuming {url} at {offset} bytes")
+            with open(partial, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    h.update(chunk)
+        else:
+            print(f"[*] Downloading {url}")
+        if res.status_code != 416:
+            with open(partial, "ab" if offset else "wb") as f:
+                for chunk in res.iter_content(chunk_size):
+                    f.write(chunk)
+                    h.update(chunk)
+
+    sha256 = h.hexdigest()
+    archive = store.get(sha256)
+    if archive:
+        os.remove(partial)
+    else:
+        archive = store.commit(partial, sha256)
+    urls.set(key, {"url": url, "sha256": sha256})
+    return archive
+
+def _members(archive: str, fmt: str):
+    """Yield (path, mode, size, reader, link) for every file in the archive. reader is a
+    file object with the contents (or None for hard links, which point at link instead)"""
+    if fmt == "zip":
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                mode = info.external_attr >> 16
+                with zf.open(info) as f:
+                    if stat.S_ISLNK(mode):
+                        target = f.read()
+                        yield info.filename, 0o120000, len(target), _Bytes(target), None
+                    else:
+                        yield info.filename, 0o100755 if mode & 0o111 else 0o100644, info.file_size, f, None
+        return
+    # Stream mode reads each member once, in order, without seeking
+    with tarfile.open(archive, "r|*") as tf:
+        for info in tf:
+            if info.isreg():
+                yield info.name, 0o100755 if info.mode & 0o111 else 0o100644, info.size, tf.extractfile(info), None
+            elif info.issym():
+                target = info.linkname.encode("utf-8", "surrogateescape")
+                yield info.name, 0o120000, len(target), _Bytes(target), None
+            elif info.islnk():
+                yield info.name, 0, 0, None, info.linkname
+
+class _Bytes:
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    def read(self, n=-1) -> bytes:
+        data, self.data = (self.data, b"") if n < 0 else (self.data[:n], self.data[n:])
+        return data
+
+def _clean(p: str) -> str:
+    """Normalize a path in an archive ('./a//b' -> 'a/b')"""
+    return "/".join(c for c in p.split("/") if c and c != ".")
+
+class FastImport:
+    """Import release archives with a single `git fast-import`. Each version becomes a
+    commit on the current branch holding exactly the files of the archive, plus an
+    annotated tag. Nothing is unpacked to disk and the working tree is only updated
+    (once) when the import is done. Every finished version is checkpointed, so an error
+    only loses the version that was being imported
+
+        with FastImport(dest) as fi:
+            fi.add_version(archive, url, version, fmt)
+    """
+    def __init__(self, directory: str) -> None:
+        self.dir = directory
+        self.proc = None
+        self._mark = 0
+        self._parent = None
+        self.imported = [] # Versions that are checkpointed
+
+    def _git(self, *args) -> str:
+        res = subprocess.run(
+            ["git", *args],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.dir,
+            encoding="utf-8"
+        )
+        if res.returncode != 0:
+            raise ValueError(f"git {args[0]}: {res.stderr}")
+        return res.stdout.strip()
+
+    def __enter__(self):
+        if self._git("status", "--porcelain", "--untracked-files=no"):
+            raise ValueError(f"Uncommitted changes exist in {self.dir}. Refusing to import")
+        self.branch = self._git("symbolic-ref", "HEAD")
+        # Continue the branch if it has commits, fast-import starts a new root otherwise
+        res = subprocess.run(["git", "rev-parse", "--verify", "-q", "HEAD"], stdout=subprocess.PIPE, cwd=self.dir, encoding="utf-8")
+        self._parent = res.stdout.strip() if res.returncode == 0 else None
+        self.ident = self._git("var", "GIT_COMMITTER_IDENT")
+        self.proc = subprocess.Popen(
+            ["git", "fast-import", "--quiet"],
+            stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.dir,
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.proc is not None:
+            # The failed version never got its commit and a blob that was cut off makes
+            # fast-import give up, so ending the stream keeps only the checkpointed versions
+            proc, self.proc = self.proc, None
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+            proc.stderr.read()
+            proc.wait()
+            if self.imported:
+                self._git("read-tree", "-u", "--reset", "HEAD")
+            return
+        self.close()
+
+    def _write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8", "surrogateescape")
+        self.proc.stdin.write(data)
+
+    def _data(self, data: bytes):
+        self._write(f"data {len(data)}\n")
+        self._write(data)
+        self._write("\n")
+
+    def add_version(self, archive: str, url: str, version: str, fmt: str):
+        """Stream every file of the archive into a blob, then commit them and tag the commit"""
+        files = {} # path -> (mode, mark)
+        for name, mode, size, reader, link in _members(archive, fmt):
+            name = _clean(name)
+            if not name:
+                continue
+            if link is not None:
+                if _clean(link) in files:
+                    files[name] = files[_clean(link)]
+                continue
+            self._mark += 1
+            self._write(f"blob\nmark :{self._mark}\ndata {size}\n")
+            copied = 0
+            for chunk in iter(lambda: reader.read(1 << 20), b""):
+                self._write(chunk)
+                copied += len(chunk)
+            if copied != size:
+                raise ValueError(f"{archive}: short read of {name}")
+            self._write("\n")
+            files[name] = (mode, self._mark)
+
+        # If everything is in a single folder, move it out of the folder
+        tops = {p.split("/", 1)[0] for p in files}
+        if len(tops) == 1 and all("/" in p for p in files):
+            strip = len(tops.pop()) + 1
+            files = {p[strip:]: f for p, f in files.items()}
+
+        self._mark += 1
+        commit = self._mark
+        self._write(f"commit {self.branch}\nmark :{commit}\ncommitter {self.ident}\n")
+        self._data(url.encode("utf-8"))
+        if self._parent:
+            self._write(f"from {self._parent}\n")
+        self._write("deleteall\n")
+        for p in sorted(files):
+            mode, mark = files[p]
+            self._write(f"M {mode:o} :{mark} {p}\n")
+        self._write("\n")
+        self._write(f"tag {version}\nfrom :{commit}\ntagger {self.ident}\n")
+        self._data(url.encode("utf-8"))
+        # Write out the pack and update the branch and the tag so far
+        self._write("checkpoint\n\n")
+        self._parent = f":{commit}"
+        self.imported.append(version)
+
+    def close(self):
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        proc.stdin.close()
+        err = proc.stderr.read().decode("utf-8", "replace")
+        if proc.wait() != 0:
+            raise ValueError(f"git fast-import: {err}")
+        if self.imported:
+            # Bring the index and working tree up to the last version in one go
+            self._git("read-tree", "-u", "--reset", "HEAD")
@@ -1,4 +1,146 @@
+import re
+
 from os import path
+from typing import List
+
+from shipyard.cache import digest
+
+_HUNK = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+def _lines(buf: str, start=0):
+    """Yield (offset, line) for every line in buf, without the newline"""
+    n = len(buf)
+    while start < n:
+        end = buf.find("\n", start)
+        if end < 0:
+            end = n
+        yield start, buf[start:end]
+        start = end + 1
+
+def _strip_path(p: str, strip=1) -> str:
+    """'a/foo/bar.c\t2024-01-01' -> 'foo/bar.c'. None for /dev/null"""
+    p = p.split("\t")[0].strip()
+    if p == "/dev/null":
+        return None
+    if p.count("/") < strip:
+        return p
+    return p.split("/", strip)[-1]
+
+class Hunk:
+    """A single @@ block. start and end are offsets of the block (header line included)
+    in the buffer of the patch it came from"""
+    __slots__ = ("buf", "old_start", "old_len", "new_start", "new_len", "start", "end")
+
+    def __init__(self, buf: str, start: int, old_start: int, old_len: int, new_start: int, new_len: int) -> None:
+        self.buf = buf
+        self.start = start
+        self.end = start
+        self.old_start = old_start
+        self.old_len = old_len
+        self.new_start = new_start
+        self.new_len = new_len
+
+    @property
+    def text(self) -> str:
+        return self.buf[self.start:self.end]
+
+    @property
+    def body(self) -> str:
+        """The lines of the hunk, without the @@ header"""
+        nl = self.buf.find("\n", self.start, self.end)
+        return "" if nl < 0 else self.buf[nl+1:self.end]
+
+class FileDiff:
+    """The part of a patch that changes one file. old and new are the paths as written
+    in the patch ('a/foo.c', '/dev/null'), start/body/end are offsets into the patch
+    buffer of the file's first header line, its first hunk, and its end"""
+    __slots__ = ("buf", "old", "new", "start", "body", "end", "hunks")
+
+    def __init__(self, buf: str, start: int, old="", new="") -> None:
+        self.buf = buf
+        self.old = old
+        self.new = new
+        self.start = start
+        self.body = start
+        self.end = start
+        self.hunks: List[Hunk] = []
+
+    @property
+    def old_path(self) -> str:
+        return _strip_path(self.old)
+
+    @property
+    def new_path(self) -> str:
+        return _strip_path(self.new)
+
+    @property
+    def path(self) -> str:
+        """The path this diff applies to, relative to the source (like git apply -p1)"""
+        p = self.new_path
+        return p if p is not None else self.old_path
+
+    @property
+    def header(self) -> str:
+        """Everything before the first hunk (diff --git, index, ---, +++ lines)"""
+        return self.buf[self.start:self.body]
+
+    @property
+    def text(self) -> str:
+        return self.buf[self.start:self.end]
+
+def parse_files(buf: str) -> List[FileDiff]:
+    """Split a patch into per-file and per-hunk records without copying any text. Hunks
+    run until the next line that cannot be part of one, so their counts do not need to
+    be right (like git apply --recount)"""
+    files = []
+    cur: FileDiff = None
+    hunk: Hunk = None
+    pending: FileDiff = None # A diff --git file still waiting for its ---/+++ lines
+    lines = _lines(buf)
+    nxt = next(lines, None)
+    while nxt is not None:
+        off, line = nxt
+        end = min(off + len(line) + 1, len(buf))
+        nxt = next(lines, None)
+        if line.startswith("diff --git "):
+            old, _, new = line[len("diff --git "):].partition(" b/")
+            cur = FileDiff(buf, off, old, "b/" + new)
+            cur.end = cur.body = end
+            files.append(cur)
+            pending = cur
+            hunk = None
+        elif line.startswith("--- ") and nxt is not None and nxt[1].startswith("+++ "):
+            if cur is None or cur is not pending:
+                cur = FileDiff(buf, off)
+                files.append(cur)
+            # Paths from ---/+++ win over the ones guessed from diff --git
+            cur.old = line[4:].strip()
+            cur.new = nxt[1][4:].strip()
+            pending = None
+            off, line = nxt
+            end = min(off + len(line) + 1, len(buf))
+            nxt = next(lines, None)
+            cur.end = cur.body = end
+            hunk = None
+        elif cur is not None and line.startswith("@@"):
+            m = _HUNK.match(line)
+            if not m:
+                hunk = None
+                continue
+            o, ol, n, nl = m.groups()
+            pending = None
+            hunk = Hunk(buf, off, int(o), 1 if ol is None else int(ol), int(n), 1 if nl is None else int(nl))
+            hunk.end = cur.end = end
+            cur.hunks.append(hunk)
+        elif hunk is not None and (line[:1] in (" ", "-", "+", "\\") or not line.strip("\r")):
+            hunk.end = cur.end = end
+        elif cur is not None and cur is pending:
+            # Extended git headers (index, new file mode, rename from, ...)
+            cur.end = cur.body = end
+            hunk = None
+        else:
+            hunk = pending = None # Something between files, leave it out
+    return files
 
 class PatchFile:
     def __init__(self, contents="", filename=""):
@@ -8,7 +150,13 @@ class PatchFile:
         self.FullIndex = ""
         self.Filename = filename
         self.RawHeader = ""
+        self._lazy = False # Contents are still on disk, see from_record
+        self._digest = None
         self.contents: str = contents
+        self._files = None
+        self._files_of = None
+        self._dumped = None
+        self._dump_key = None
         if filename:
             _, fname = path.split(filename)
             self.Name, _ = path.splitext(fname)
@@ -25,47 +173,102 @@ class PatchFile:
     def parse(self):
         if not self.contents:
             return
+        text = self.contents
         header = []
-        prev = ""
-        new_contents = []
-        skipNext = False
-        # For importing, we can skip the header
-        for line in self.contents.splitlines():
-            if skipNext:
-                skipNext = False
-                continue
-            
-            if line.startswith("diff --git a"):
-                skipNext = True
-                continue
-            if line.startswith("--- "):
-                header += [" "]
-                self.RawHeader = "\n".join(header)
-                prev = line
-
-            if not self.RawHeader:
-                if line.startswith("Index: ") or line.startswith("==================="):
-                    continue
-                header.append(line)
+        body = -1
+        # Everything up to the first file is the description. For importing, skip
+        # the Index: header we add on dump
+        for off, line in _lines(text):
+            if line.startswith("diff --git ") or (line.startswith("--- ") and text.startswith("+++ ", off + len(line) + 1)):
+                body = off
+                break
+            if line.startswith("Index: ") or line.startswith("==================="):
                 continue
-            new_contents.append(line)
-            if prev.startswith("--- ") and line.startswith("+++ "):
-                index = line.lstrip("+ ")
-                self.FullIndex = index
-            prev = line
-
-        index = index.split(path.sep)[1:]
-        self.Index = path.join(*index)
-        self.contents = "\n".join(new_contents)
+            header.append(line)
+        if body < 0:
+            raise ValueError("no diff found in patch")
+
+        self.RawHeader = "\n".join(header + [" "])
         self.Description = "\n".join(header).strip()
-        if not header:
-            return
+        contents = text[body:]
+        self.contents = contents[:-1] if contents.endswith("\n") else contents
+        files = self.files
+        if not files:
+            raise ValueError("no diff found in patch")
+        last = files[-1]
+        self.FullIndex = last.new if last.new_path is not None else last.old
+        self.Index = last.path
+
+    @property
+    def contents(self) -> str:
+        if self._lazy:
+            self._lazy = False
+            with open(self.Filename) as f:
+                self._contents = f.read()
+            self.parse()
+        return self._contents
+
+    @contents.setter
+    def contents(self, contents: str):
+        self._lazy = False
+        self._contents = contents
+        self._digest = None
+
+    @property
+    def digest(self) -> str:
+        """A hash of the dumped patch. Known without reading the file for lazy patches"""
+        if self._digest is None:
+            self._digest = digest(self.dump())
+        return self._digest
+
+    @property
+    def files(self) -> List[FileDiff]:
+        """The per-file records of the patch, parsed again only if the contents change"""
+        if self._files is None or self._files_of is not self.contents:
+            self._files = parse_files(self.contents)
+            self._files_of = self.contents
+        return self._files
+
+    @property
+    def paths(self) -> List[str]:
+        """Every path the patch touches, relative to the source"""
+        paths = []
+        for f in self.files:
+            for p in (f.old_path, f.new_path):
+                if p is not None and p not in paths:
+                    paths.append(p)
+        return paths
     
     @classmethod
     def from_file(cls, filename):
         with open(filename) as f:
             return cls(f.read(), filename=filename)
 
+    def to_record(self) -> dict:
+        """The parsed headers of the patch, for rebuilding it with from_record"""
+        return {
+            "name": self.Name,
+            "description": self.Description,
+            "index": self.Index,
+            "full_index": self.FullIndex,
+            "raw_header": self.RawHeader,
+            "digest": self.digest,
+        }
+
+    @classmethod
+    def from_record(cls, filename, record: dict):
+        """A patch built from to_record. The file is only read (and parsed) once the
+        contents are needed"""
+        p = cls(filename=filename)
+        p.Name = record["name"]
+        p.Description = record["description"]
+        p.Index = record["index"]
+        p.FullIndex = record["full_index"]
+        p.RawHeader = record["raw_header"]
+        p._digest = record["digest"]
+        p._lazy = True
+        return p
+
     def __hash__(self) -> int:
         return hash(self.Name)
     
@@ -81,11 +284,41 @@ class PatchFile:
                 return True
         return None
     
+    def _with_git_headers(self) -> str:
+        """git apply --recount cannot tell where a file ends in a plain multi-file diff (the
+        next '--- ' looks like a removed line), so give every file a diff --git header"""
+        files = self.files
+        if len(files) < 2 or all(self.contents.startswith("diff --git ", f.start) for f in files):
+            return self.contents
+        out, last = [], 0
+        for f in files:
+            if self.contents.startswith("diff --git ", f.start):
+                continue
+            out.append(self.contents[last:f.start])
+            out.append(f"diff --git a/{f.path} b/{f.path}\n")
+            if f.old_path is None:
+                out.append("new file mode 100644\n")
+            elif f.new_path is None:
+                out.append("deleted file mode 100644\n")
+            last = f.start
+        out.append(self.contents[last:])
+        return "".join(out)
+
     def dump(self, variables={}):
+        if not variables:
+            # Patches get dumped on every apply/check, only build the text once
+            key = (self.Description, self.FullIndex, self.contents)
+            if self._dump_key != key:
+                self._dumped = self._dump()
+                self._dump_key = key
+            return self._dumped
+        return self._dump(variables)
+
+    def _dump(self, variables={}):
         desc = ""
         if self.Description:
             desc = self.Description+"\n"
-        contents = self.contents
+        contents = self._with_git_headers()
         for k, v in variables.items():
             contents = contents.replace(k, v)
-        return f"{desc}Index: {self.FullIndex}\n{'='*67}\n{contents}\n"
\ No newline at end of file
+        return f"{desc}Index: {self.FullIndex}\n{'='*67}\n{contents}\n"
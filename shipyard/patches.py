@@ -1,12 +1,17 @@
 import inspect
+import itertools
 import glob
 import re
 import fnmatch
 import subprocess
 import shutil
+import multiprocessing
+import json
+import tempfile
 
-from os import path, walk, makedirs
+from os import path, walk, makedirs, scandir, stat, fdopen, replace
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from typing import List
 
 try:
@@ -15,29 +20,73 @@ except ImportError:
     from distutils.dir_util import copy_tree as copytree
 
 from shipyard.patch import PatchFile
-from shipyard.utils import _load_object, getClosestVersions
+from shipyard.codepatch import CodePatchIndex
+from shipyard.cache import Cache, digest, file_digest
+from shipyard.utils import _load_object
 from shipyard.git import SourceProgram, SourceManager, GitMgr
-from shipyard.version import Version
+from shipyard.gitbatch import BatchGitMgr
+from shipyard.version import Version, VersionIndex
 from shipyard.jumpstart import jumpstart
 
+def _gitignore_matcher(filename):
+    """Compile the patterns of a .gitignore into a single matcher(relpath, name, is_dir)"""
+    if not path.isfile(filename):
+        return None
+    pats, dir_pats = [], []
+    with open(filename) as f:
+        for line in f.read().splitlines():
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith("!"):
+                continue
+            (dir_pats if line.endswith("/") else pats).append(fnmatch.translate(line.strip("/")))
+    if not pats and not dir_pats:
+        return None
+    match = re.compile("|".join(pats)).match if pats else None
+    dir_match = re.compile("|".join(dir_pats)).match if dir_pats else None
+    def matcher(rel, name, is_dir):
+        if match and (match(name) or match(rel)):
+            return True
+        return bool(is_dir and dir_match and (dir_match(name) or dir_match(rel)))
+    return matcher
+
+# The Patches object that forked CodePatch workers run with
+_pool_patches = None
+
+# Source managers that can be picked with Patches(backend=...)
+PATCH_INDEX_FORMAT = 1 # Bump when PatchFile.to_record changes
+
+BACKENDS = {
+    "git": GitMgr,
+    "batch": BatchGitMgr,
+}
+
 class Patches:
     """A manager for the patches that loops through a directory to figure out
     each version supported and that patches that we have for each one"""
-    def __init__(self, directory=".", pull=True):
+    def __init__(self, directory=".", pull=True, backend="git", cache=True):
         self._dir = directory
+        # Results of patch tests, keyed by what was tested and the tree it was tested on
+        self.results = Cache(path.join(directory, ".shipyard", "results")) if cache else None
+        self.exports = Cache(path.join(directory, ".shipyard", "exports"), max_entries=256) if cache else None
         self.patches = {}
         self.code_patches = {} # Patches that are functions and not .patch files
         self.code_res = defaultdict(list) # when a file matches an RE in this array, goto the func it points to
+        self._code_idx = None
         self.versions = {}
+        self.version_index = VersionIndex() # The versions that have patches
         self.infoObject: SourceProgram
         self._files = [] # List of all files in the source
+        self._tree_files = {} # git tree -> tracked files in it
+        self._cache = cache
+        self._patch_index = path.join(directory, ".shipyard", "patches.json")
         self.load()
 
         # Jumpstart the URLs into a git repo _before_ passing to the git MGR
         if not self.infoObject.Url and self.infoObject.Urls:
             jumpstart(self.infoObject.resolve_source_directory(), self.infoObject.Urls)
-        # If we wanted, we could use a different source manager here
-        self.source:SourceManager = GitMgr(self.infoObject)
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown source backend '{backend}'. Expected one of: {', '.join(BACKENDS)}")
+        self.source:SourceManager = BACKENDS[backend](self.infoObject)
 
         if pull:
             self.source.prepare()
@@ -45,18 +94,37 @@ class Patches:
         else:
             self._ver = ""
 
-    def _checkout(self, version):
-        """Checkout a version"""
+    def _checkout(self, version, full=False):
+        """Checkout a version. With SparseCheckout in the shipfile only the files we patch
+        are written, unless full is set"""
         self.source.reset()
+        if self.infoObject.SparseCheckout:
+            self.source.sparse(None if full else self.sparse_paths(version))
         self.source.checkout(Version(version))
         self._ver = version
 
+    def sparse_paths(self, version) -> List[str]:
+        """The files patching version needs: every path a patchfile (of any version)
+        touches and every file of version that a CodePatch matches"""
+        paths = {p for patches in self.versions.values() for patch in patches for p in patch.paths}
+        index = self._code_index()
+        if self.code_res:
+            paths.update(f for f in self.source.list_files(version) if index.match(f))
+        return sorted(paths)
+
     def _load_code_patch(self, cp):
         """Load the regexs for a single CodePatch"""
         self.code_patches[cp.__name__] = cp
         for reg in getattr(cp, "__patch_files", []):
             r = re.compile(reg)
             self.code_res[r].append(cp)
+        self._code_idx = None
+
+    def _code_index(self) -> CodePatchIndex:
+        """The dispatch index for code_res, rebuilt after CodePatches are loaded"""
+        if self._code_idx is None:
+            self._code_idx = CodePatchIndex(self.code_res)
+        return self._code_idx
     
     def load(self):
         """Load and parse the shipfile as well as the patches"""
@@ -65,6 +133,7 @@ class Patches:
             obj = _load_object(f)
             if obj is not None:
                 self.infoObject = SourceProgram.from_object(obj)
+                self._shipfile_hash = file_digest(f)
                 # Load the code patches from the obj
                 for _, func in inspect.getmembers(obj, predicate=inspect.isfunction):
                     if getattr(func, "__patch_files", False):
@@ -73,6 +142,10 @@ class Patches:
         if not self.infoObject:
             raise ValueError("Shipfile not detected")
         
+        # Patches that have not changed since the last run are rebuilt from the index
+        # and only read from disk when something needs their contents
+        index = self._read_patch_index()
+        new_index = {}
         for root, dirs, files in walk(self._dir):
             if dirs:
                 continue
@@ -82,47 +155,112 @@ class Patches:
             for p in files:
                 if not p.endswith(".diff") and not p.endswith(".patch"):
                     continue
+                fname = path.join(root, p)
+                rel = path.relpath(fname, self._dir)
                 try:
-                    patch = PatchFile.from_file(path.join(root, p))
+                    st = stat(fname)
+                    rec = index.get(rel)
+                    if rec and rec["mtime"] == st.st_mtime_ns and rec["size"] == st.st_size:
+                        patch = PatchFile.from_record(fname, rec)
+                    else:
+                        patch = PatchFile.from_file(fname)
+                        rec = dict(patch.to_record(), mtime=st.st_mtime_ns, size=st.st_size, version=str(version))
                 except Exception:
                     raise ValueError(f"Invalid patchfile '{p}'")
+                new_index[rel] = rec
                 #patch.update(self.infoObject.Variables)
                 self.patches[patch.Name] = patch
                 self.versions[version].add(patch)
             if not self.versions[version]:
                 del self.versions[version]
-    
-    def get_file_list(self, base_dir="") -> List[str]:
-        """List files, honoring the .gitignore
-        
-        https://stackoverflow.com/questions/70745060/how-to-list-directory-files-excluding-files-in-gitignore
-        https://stackoverflow.com/a/19859907
+        self.version_index = VersionIndex(self.versions)
+        if new_index != index:
+            self._write_patch_index(new_index)
+
+    def _read_patch_index(self) -> dict:
+        """The saved patch index (relative path -> record), empty if there is none"""
+        if not self._cache:
+            return {}
+        try:
+            with open(self._patch_index) as f:
+                index = json.load(f)
+            return index["patches"] if index.get("format") == PATCH_INDEX_FORMAT else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _write_patch_index(self, index: dict):
+        if not self._cache:
+            return
+        index = {"format": PATCH_INDEX_FORMAT, "patches": index}
+        try:
+            makedirs(path.dirname(self._patch_index), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.dirname(self._patch_index), suffix=".tmp")
+            with fdopen(fd, "w") as f:
+                json.dump(index, f)
+            replace(tmp, self._patch_index)
+        except OSError as e:
+            print(f"[!] Could not save the patch index: {e}")
+
+    def get_file_list(self, base_dir="", untracked=False) -> List[str]:
+        """List files, honoring the .gitignore. See iter_files"""
+        self._files = list(self.iter_files(base_dir, untracked=untracked))
+        return self._files
+
+    def iter_files(self, base_dir="", untracked=False, source: SourceManager = None):
+        """Yield the files of the source (or base_dir), honoring the .gitignore
+
+        When the directory belongs to a source manager the file list comes from git and
+        is cached per tree, so listing the same version again costs nothing. Untracked
+        files are only included when requested. Other directories are walked.
         """
-        self._files = []
-        ignored = [".git"]
         if not base_dir:
             base_dir = self.infoObject.resolve_source_directory()
-        if path.isfile(path.join(base_dir, ".gitignore")):
-            with open(path.join(base_dir, ".gitignore")) as f:
-                ignored += [line for line in f.read().splitlines() if line]
-
-        for root, dirs, files in walk(base_dir):
-            r = path.relpath(root, base_dir)
-            if any(fnmatch.fnmatch(r, i) for i in ignored):
-                dirs[:] = []
-                continue
-            _, d = path.split(root)
-            if d in ignored or d+"/" in ignored or any(fnmatch.fnmatch(d, i) for i in ignored):
-                dirs[:] = []
+        if source is None and path.normpath(base_dir) == path.normpath(self.source.r.Directory):
+            source = self.source
+        if source is None:
+            yield from self._walk_files(base_dir)
+            return
+
+        base_dir = source.r.Directory
+        tree = source.tree_id()
+        files = self._tree_files.get(tree) if tree else None
+        if files is None:
+            files = source.list_files()
+            if tree:
+                self._tree_files[tree] = files
+        for f in files:
+            f = path.join(base_dir, f)
+            if path.lexists(f): # Patches may have removed it
+                yield f
+        if untracked:
+            tracked = set(files)
+            for f in source.list_files(untracked=True):
+                if f not in tracked:
+                    yield path.join(base_dir, f)
+
+    def _walk_files(self, base_dir):
+        """Walk a directory that git does not know about, skipping anything matched by a
+        .gitignore along the way"""
+        # Each directory with a .gitignore pushes a matcher for paths relative to it
+        stack = [(base_dir, [])]
+        while stack:
+            d, matchers = stack.pop()
+            m = _gitignore_matcher(path.join(d, ".gitignore"))
+            if m:
+                matchers = matchers + [(d, m)]
+            try:
+                entries = sorted(scandir(d), key=lambda e: e.name)
+            except OSError:
                 continue
-            for f in files:
-                if f in ignored:
+            subdirs = []
+            for e in entries:
+                if e.name == ".git" or any(m(path.relpath(e.path, md), e.name, e.is_dir()) for md, m in matchers):
                     continue
-                f = path.join(root, f)
-                ign = any(fnmatch.fnmatch(f, i) for i in ignored)
-                if not ign:
-                    self._files.append(f)
-        return self._files
+                if e.is_dir(follow_symlinks=False):
+                    subdirs.append((e.path, matchers))
+                else:
+                    yield e.path
+            stack.extend(reversed(subdirs))
 
     def apply_similar_patch(self, patch, similarversions, outdir):
         """Given patch: find other versions of the same patch and try to apply them"""
@@ -158,22 +296,17 @@ class Patches:
         if version not in actualVers:
             raise ValueError(f"Invalid version '{version}'")
         
-        # Will return empty list if we dont have any other version patches
-        closestVers = getClosestVersions(version, self.versions.keys())
+        # Every version in the index has patches, so the nearest one is where we start
+        closestVers = self.version_index.closest(version)
         # Always use ourself first
-        if version in self.versions:
+        if version in self.version_index:
             closestVers = [version] + closestVers
-        # Find the closest version WITH patches
-        patches = []
-        for v in closestVers:
-            p = self.versions.get(v)
-            if p:
-                patches = p
-                break
+        seed = self.version_index.nearest(version) or version
+        patches = self.versions.get(seed, [])
         if not patches:
-            print(f"[!] WARNING: No patchfiles found for version '{closestVers[0]}'")
+            print(f"[!] WARNING: No patchfiles found for version '{seed}'")
         else:
-            print(f"[*] Attempting to patch {version} with {len(patches)} patches from version {closestVers[0]}")
+            print(f"[*] Attempting to patch {version} with {len(patches)} patches from version {seed}")
             outdir = path.join(self._dir, self.infoObject.Patches, version)
             makedirs(outdir, exist_ok=True)
         self._checkout(version)
@@ -198,36 +331,244 @@ class Patches:
         if patches:
             print("[+] Saved patches to", outdir)
 
-    def test_patch(self, patch: PatchFile):
-        """Test a patchfile on all versions of a source code"""
+    def build_versions(self, jobs=1) -> dict:
+        """Port the patches to every version that does not have any yet. Versions are
+        done in chains moving away from a version with patches, so each version is
+        seeded with the patches just refreshed for the one before it
+
+        jobs: port this many chains at once, each in its own git worktree
+        Return: {version: (seed version, [ported patch names], [failed patch names])}
+        """
+        if not self.versions:
+            print("[!] No version has patches, there is nothing to port")
+            return {}
+        chains = self._port_chains()
+        if not chains:
+            print("[*] Every version already has patches")
+            return {}
+        print(f"[*] Porting patches to {sum(len(c) for _, c in chains)} versions in {len(chains)} chains")
+        if jobs > 1 and len(chains) > 1:
+            with self.source.worktrees(min(jobs, len(chains))) as pool, ThreadPoolExecutor(jobs) as ex:
+                results = list(ex.map(lambda c: pool.run(self._port_chain, c[1][0], c[0], c[1]), chains))
+        else:
+            results = [self._port_chain(self.source, c[0], seed, c) for seed, c in chains]
+
+        ported = {}
+        for res in results:
+            for v, (seed, ok, failed) in res:
+                if ok:
+                    version = self.version_index.add(v)
+                    self.versions[version] = set(ok.values())
+                    self.patches.update(ok)
+                ok = sorted(ok)
+                ported[v] = (seed, ok, failed)
+                t = f"[+] {v}: ported {len(ok)}/{len(ok)+len(failed)} patches from {seed}"
+                if failed:
+                    t = f"[!] {t[4:]} (failed: {', '.join(failed)})"
+                print(t)
+        return ported
+
+    def _port_chains(self) -> list:
+        """Group the versions without patches into chains [(seed, [version, ...])]. Each
+        run of versions between two patched ones is split in half, the lower half moving
+        up from the version below it and the upper half moving down from the one above"""
+        chains = []
+        run = []
+        prev = None
+        def flush(nxt):
+            half = len(run) if nxt is None else 0 if prev is None else (len(run) + 1) // 2
+            if prev is not None and run[:half]:
+                chains.append((prev, run[:half]))
+            if nxt is not None and run[half:]:
+                chains.append((nxt, run[half:][::-1]))
+        for v in self.source.versions():
+            if v in self.version_index:
+                flush(v)
+                prev, run = v, []
+            else:
+                run.append(v)
+        flush(None)
+        return chains
+
+    def _port_chain(self, source: SourceManager, version, seed, chain) -> list:
+        """Port the patches of seed along chain in source. Each patch is first tried as it
+        was refreshed for the previous version, then as any other copy of it (the seed's
+        included, closest version first) before it counts as failed"""
+        carry = {p.Name: p for p in self.versions[seed]}
+        results = []
+        for v in chain:
+            source.reset()
+            source.checkout(Version(v))
+            outdir = path.join(self._dir, self.infoObject.Patches, v)
+            ok, failed = {}, []
+            for name, p in sorted(carry.items()):
+                _, fname = path.split(p.Filename)
+                if path.exists(path.join(outdir, fname)):
+                    print(f"[!] Refusing to overwrite existing file '{path.join(outdir, fname)}'")
+                    failed.append(name)
+                    continue
+                for candidate in self._similar_patches(p, v):
+                    new = self._port_patch(source, candidate, outdir, fname)
+                    if new is not None:
+                        ok[name] = new
+                        break
+                else:
+                    failed.append(name)
+            carry.update(ok)
+            results.append((v, (seed, ok, failed)))
+            seed = v
+        source.reset()
+        return results
+
+    def _similar_patches(self, patch: PatchFile, version) -> List[PatchFile]:
+        """patch followed by the copies of it (same name) in the versions that have
+        patches, closest to version first. Copies with the same contents are left out"""
+        candidates, seen = [], set()
+        others = (o for v in self.version_index.iter_closest(version) for o in self.versions.get(v, ()) if o.Name == patch.Name)
+        for p in itertools.chain([patch], others):
+            if p.digest not in seen:
+                seen.add(p.digest)
+                candidates.append(p)
+        return candidates
+
+    def _port_patch(self, source: SourceManager, patch: PatchFile, outdir, fname) -> PatchFile:
+        """Apply patch to the checked out source and save the refreshed patch as outdir/fname"""
+        try:
+            applied = source.apply(patch, reject=False, check=True)
+        except ValueError:
+            applied = False
+        contents = source.refresh(patch) if applied else ""
+        source.reset()
+        if not contents.strip():
+            return None
+        output = path.join(outdir, fname)
+        new = PatchFile(contents, filename=output)
+        new.Description = patch.Description
+        makedirs(outdir, exist_ok=True)
+        with open(output, "w") as f:
+            f.write(new.dump())
+        return new
+
+    def test_patch(self, patch: PatchFile, jobs=1):
+        """Test a patchfile on all versions of a source code
+        
+        jobs: number of versions to test at once. CodePatches get a git worktree per
+        job so the main source directory is left alone
+        """
         is_code_patch = not isinstance(patch, PatchFile)
         if is_code_patch:
             if patch not in self.code_patches:
                 raise FileNotFoundError(f"code patch '{patch}' not found")
         
         versions = self.source.versions()
+        if not is_code_patch:
+            # Patchfiles are checked against the tree of each version, no checkout needed
+            with ThreadPoolExecutor(max(1, jobs)) as ex:
+                results = ex.map(lambda v: self._check(v, [patch])[0], versions)
+                for v, err in zip(versions, results):
+                    self._print_result(v, err)
+            return
+
+        # Only the versions without a stored result need a checkout
+        keys = {v: self._result_key("codepatch", v, patch) for v in versions}
+        known = {v: self._cached(keys[v]) for v in versions}
+        todo = [v for v in versions if known[v] is None]
+        if jobs > 1 and len(todo) > 1:
+            with self.source.worktrees(min(jobs, len(todo))) as pool, ThreadPoolExecutor(jobs) as ex:
+                self._print_results(versions, known, keys, ex.map(lambda v: pool.run(self._test_code_patch, v, patch), todo))
+            return
+
+        def run_serial():
+            for v in todo:
+                if len(versions) > 1:
+                    self._checkout(v)
+                yield self._test_code_patch(self.source, v, patch)
+        self._print_results(versions, known, keys, run_serial())
+
+    def _print_results(self, versions, known, keys, results):
+        """Print a result for every version in order, taking the ones we did not know from
+        results (in order) and storing them"""
         for v in versions:
-            if len(versions) > 1:
-                self._checkout(v)
-            if not is_code_patch:
-                if self.source.apply(patch, check=True):
-                    print("[+] PASS", v)
-                else:
-                    print("[!] FAIL", v)
+            if known[v] is not None:
+                err = known[v]["error"]
             else:
-                self.get_file_list()
-                try:
-                    for f in self._files:
-                        self.__run_patches_on_file(f, patches=[patch])
-                    print("[+] PASS", v)
-                except Exception as e:
-                    print(f"[!] FAIL {v}: {e}")
+                err = next(results)
+                self._store(keys[v], {"error": err})
+            self._print_result(v, err)
+
+    def _result_key(self, kind, version, *parts) -> str:
+        """Key for a stored result of version, or None if results cannot be stored"""
+        if self.results is None:
+            return None
+        tree = self.source.tree_id(version)
+        if not tree:
+            return None
+        return digest(kind, tree, self._shipfile_hash, *parts)
+
+    def _cached(self, key):
+        return self.results.get(key) if key else None
+
+    def _store(self, key, value):
+        if key:
+            self.results.set(key, value)
+
+    def _check(self, version, patches: List[PatchFile]) -> List[str]:
+        """source.check, remembering the results for each tree and set of patches"""
+        key = self._result_key("check", version, *[p.digest for p in patches])
+        res = self._cached(key)
+        if res is None:
+            res = {"errors": self.source.check(version, patches)}
+            self._store(key, res)
+        return res["errors"]
+
+    def _print_result(self, version, err):
+        if err is None:
+            print("[+] PASS", version)
+        elif err:
+            print(f"[!] FAIL {version}: {err}")
+        else:
+            print("[!] FAIL", version)
+
+    def _test_code_patch(self, source: SourceManager, version, patch) -> str:
+        """Run a CodePatch against the checked out version of source. Returns None on success
+        or the reason it failed"""
+        base = source.r.Directory
+        try:
+            for f in self.iter_files(source=source):
+                self.__run_patches_on_file(f, patches=[patch], base=base, version=version, source=source)
+        except Exception as e:
+            return str(e)
+        return None
+
+    def matrix(self, jobs=1) -> list:
+        """Check every version against the patches that would be used to build it (its own, or
+        the closest version that has patches) without checking anything out
+        
+        Return: [(version, patch_version, {patch_name: error or None})]
+        """
+        def check(version):
+            seed = self.version_index.nearest(version)
+            if seed is None:
+                return version, None, {}
+            patches = sorted(self.versions[seed], key=lambda p: p.Name)
+            errors = self._check(version, patches)
+            return version, seed, {p.Name: e for p, e in zip(patches, errors)}
+
+        with ThreadPoolExecutor(max(1, jobs)) as ex:
+            return list(ex.map(check, self.source.versions()))
     
-    def apply_code_patches(self, patches=[]):
+    def apply_code_patches(self, patches=[], jobs=1):
+        """Run the CodePatches (or the given subset) on every file in self._files
+
+        jobs: run the files across a pool of this many processes. Needs fork() so the
+        workers can share the loaded shipfile, otherwise the files are patched serially
+        """
         for funcs in self.code_res.values():
             # Reset the run check
             for f in funcs:
                 setattr(f, "__patch_has_run", False)
+        if jobs > 1 and len(self._files) > 1 and "fork" in multiprocessing.get_all_start_methods():
+            return self._apply_code_patches_parallel(patches, jobs)
         cfs = set()
         files = set()
         for f in self._files:
@@ -237,72 +578,146 @@ class Patches:
                 files.add(f)
         return cfs, files
 
-    def __run_patches_on_file(self, file, patches=[]) -> set():
-        """Run all eligable (within an optional subset) CodePatches on the given file"""
-        can_run_on = set()
-        r: re.Pattern
-        
+    def _apply_code_patches_parallel(self, patches, jobs):
+        """Shard self._files across a process pool. Results are gathered in file order so
+        the first error reported is the same one a serial run would hit"""
+        global _pool_patches
+        cfs = set()
+        files = set()
         base = self.infoObject.resolve_source_directory()
+        n = max(1, len(self._files) // (jobs * 8))
+        chunks = [self._files[i:i+n] for i in range(0, len(self._files), n)]
+        _pool_patches = self # Inherited by the forked workers
+        try:
+            with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("fork")) as ex:
+                futures = [ex.submit(Patches._code_patch_chunk, [(f, patches, base, self._ver) for f in c]) for c in chunks]
+                for chunk, future in zip(chunks, futures):
+                    for f, (ran, done, err) in zip(chunk, future.result()):
+                        # The workers flags are lost with the process, replay them here
+                        for name in done:
+                            setattr(self.code_patches[name], "__patch_has_run", True)
+                        if done:
+                            self.source.track([path.relpath(f, self.source.r.Directory)])
+                        if ran:
+                            cfs.update(self.code_patches[name] for name in ran)
+                            files.add(f)
+                        if err:
+                            # Drop the chunks that have not started (cancel_futures needs 3.9)
+                            for fut in futures:
+                                fut.cancel()
+                            raise ValueError(err)
+        finally:
+            _pool_patches = None
+        return cfs, files
+
+    @staticmethod
+    def _code_patch_chunk(tasks) -> list:
+        """Run _code_patch_worker on each task of a chunk inside a pool worker"""
+        return [Patches._code_patch_worker(t) for t in tasks]
+
+    @staticmethod
+    def _code_patch_worker(task) -> "tuple[list, list, str]":
+        """Run the CodePatches on a single file inside a pool worker
+
+        Return: names of the patches that ran, names of the patches marked as run, error
+        """
+        self = _pool_patches
+        file, patches, base, version = task
+        for f in self.code_patches.values():
+            setattr(f, "__patch_has_run", False)
+        ran, err = [], ""
+        try:
+            ran = [f.__name__ for f in self.__run_patches_on_file(file, patches=patches, base=base, version=version)]
+        except ValueError as e:
+            err = str(e)
+        done = [name for name, f in self.code_patches.items() if getattr(f, "__patch_has_run", False)]
+        return ran, done, err
+
+    def __run_patches_on_file(self, file, patches=[], base=None, version=None, source=None) -> set():
+        """Run all eligable (within an optional subset) CodePatches on the given file.
+        base, version and source default to the main source directory, the current version
+        and our source manager"""
+        can_run_on = []
+        
+        if base is None:
+            base = self.infoObject.resolve_source_directory()
+        if version is None:
+            version = self._ver
         rel_file = file
         if file.startswith(base):
             rel_file = file[len(base):]
 
-        for r, funcs in self.code_res.items():
-            if r.fullmatch(rel_file) or r.fullmatch(rel_file.lstrip("/")):
-                for f in funcs:
-                    if patches and f.__name__ not in patches:
-                        continue # This patch is not in the given subset, skip it
-                    vers = getattr(f, "__patch_versions", [])
-                    if vers and self._ver not in vers:
-                        # This patch does not apply to this version. Mark it as run though so we dont error
-                        setattr(f, "__patch_has_run", True)
-                        continue
-                    can_run_on.add(f)
+        index = self._code_index()
+        for f in index.match(rel_file):
+            if patches and f.__name__ not in patches:
+                continue # This patch is not in the given subset, skip it
+            if not index.runs_on(f, version):
+                # This patch does not apply to this version. Mark it as run though so we dont error
+                setattr(f, "__patch_has_run", True)
+                continue
+            can_run_on.append(f)
+        if can_run_on:
+            source = source or self.source
+            source.track([path.relpath(file, source.r.Directory)])
         for f in can_run_on:
             try:
-                # Some CodePatches may take a version string. If this is the case, pass the version
-                spec = inspect.getfullargspec(f)
                 setattr(f, "__patch_has_run", True)
-
-                if len(spec.args) > 1:
-                    f(file, Version(self._ver))
+                # Some CodePatches may take a version string. If this is the case, pass the version
+                if index.takes_version[f]:
+                    f(file, Version(version))
                 else:
                     f(file) # Dont pass the version to this one
             except Exception as e:
                 raise ValueError(f"shipfile.{f.__name__} failed on {file}: {e}")
-        return can_run_on
+        return set(can_run_on)
 
     def validate_version(self, version: str):
         """Validate that a version is compatible with all the patches we have for it"""
         if version not in self.versions:
             raise ValueError("No patches found for version " + version)
-        self._checkout(version)
-        try:
-            for p in self.versions[version]:
-                self.source.apply(p)
-            print("[+] All patches successfully applied")
-        finally:
-            self.source.reset()
+        patches = sorted(self.versions[version], key=lambda p: p.Name)
+        errors = self._check(version, patches)
+        failed = [f"{p.Name}: {e}" for p, e in zip(patches, errors) if e is not None]
+        if failed:
+            raise ValueError("\n".join(failed))
+        print("[+] All patches successfully applied")
+
 
+    def export(self, version="", jobs=1) -> str:
+        """Apply all patches and CodePatches to a version and dump out a new patchfile with all the changes
 
-    def export(self, version="") -> str:
-        """Apply all patches and CodePatches to a version and dump out a new patchfile with all the changes"""
+        jobs: number of processes to run the CodePatches with
+        """
         vers = self.source.versions()
         if not version:
             if vers:
                 version = vers[-1]
             else:
                 raise ValueError("No versions found to export")
+
+        # Same tree, patches, shipfile and variables give the same export
+        patchfiles = sorted(self.versions.get(version, []), key=lambda p: p.Name)
+        key = None
+        if self.exports is not None:
+            tree = self.source.tree_id(version)
+            if tree:
+                variables = sorted((str(k), str(v)) for k, v in self.infoObject.Variables.items())
+                key = digest("export", version, tree, self._shipfile_hash, variables, *[p.digest for p in patchfiles])
+                res = self.exports.get(key)
+                if res is not None:
+                    return res["patch"], {self.code_patches.get(n, n) for n in res["patches"]}
         
         self._checkout(version)
 
-        patches, _ = self.patch(self.versions.get(version, []))
+        patches, _ = self.patch(patchfiles, jobs=jobs)
         new_patch = f"{self.infoObject.Name} {version}\n"
         new_patch += self.source.refresh()
 
         # Sub all the vars
         for k, v in self.infoObject.Variables.items():
             new_patch = new_patch.replace(k, v)
+        if key:
+            self.exports.set(key, {"patch": new_patch, "patches": sorted(getattr(p, "__name__", p) for p in patches)})
         return new_patch, patches
     
     def export_from(self, directory):
@@ -356,7 +771,7 @@ class Patches:
             patch = patch.replace(k, v)
         return patch
 
-    def patch(self, patches=[], codepatches=[]) -> "tuple[set, set]":
+    def patch(self, patches=[], codepatches=[], jobs=1) -> "tuple[set, set]":
         """Patch source_dir with the given patches and the given codepatches
         
         Return: patches_run, files_changed
@@ -366,10 +781,9 @@ class Patches:
         self.get_file_list()
 
         # Call the pre_patch hook
-        if self.infoObject.pre_patches and callable(self.infoObject.pre_patches):
-            self.infoObject.pre_patches()
+        self._run_hook(self.infoObject.pre_patches)
 
-        run_patches, files = self.apply_code_patches(codepatches)
+        run_patches, files = self.apply_code_patches(codepatches, jobs=jobs)
         patch: PatchFile
         for patch in patches:
             self.source.apply(patch)
@@ -382,11 +796,17 @@ class Patches:
                 raise AssertionError(f"Code patch {cf.__name__} did not run and is required")
         
         # Call the post_patch hook
-        if self.infoObject.post_patches and callable(self.infoObject.post_patches):
-            self.infoObject.post_patches()
+        self._run_hook(self.infoObject.post_patches)
 
         return run_patches, files
 
+    def _run_hook(self, hook):
+        """Call a shipfile hook, if one was defined"""
+        if not hook or not callable(hook) or getattr(hook, "__func__", None) is SourceProgram._none:
+            return
+        self.source.track() # Hooks can touch anything, the next reset has to clean everything
+        hook()
+
     def dump(self):
         print("patches versions:", list(self.versions.keys()))
         print("\npatches:", list(self.patches.keys()))
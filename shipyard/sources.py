@@ -26,6 +26,10 @@ class SourceProgram:
     Variables = {}
     IgnoredVersions = []
     Urls = [] # Pass a list of urls instead of a git repo
+    # Partial clone filter for huge repos: "blobless" (blob:none), "treeless" (tree:0) or any git --filter spec
+    CloneFilter = ""
+    FetchTagsOnly = False # Only fetch the tags matching VersionTags, no branches
+    SparseCheckout = False # Only check out the files that patches and CodePatches touch
 
     """If the version string is different than the git tag, do the conversions here"""
     def _identity(_, s): return s
@@ -40,7 +44,7 @@ class SourceProgram:
     pre_patches = _none
     post_patches = _none
 
-    _default_attributes = ("Url", "source_directory", "pre_patches", "post_patches", "tag_to_version", "version_to_tag", "is_version_ignored", "Urls", "VersionTags", "Patches", "Variables", "Package")
+    _default_attributes = ("Url", "source_directory", "pre_patches", "post_patches", "tag_to_version", "version_to_tag", "is_version_ignored", "Urls", "VersionTags", "Patches", "Variables", "Package", "CloneFilter", "FetchTagsOnly", "SparseCheckout")
 
     def __init__(self, name) -> None:
         self.source_directory = None
@@ -76,6 +80,19 @@ class SourceManager:
         """Ensure we have the source code when we need it"""
         raise NotImplementedError()
 
+    def tag(self, version) -> str:
+        """Return the tag of a version"""
+        raise NotImplementedError()
+
+    def fetch(self) -> List[str]:
+        """Get new versions from upstream and return the new tags"""
+        return []
+
+    def sparse(self, paths: List[str] = None) -> None:
+        """Only check out paths from now on. None goes back to checking out everything.
+        Managers that cannot do this always check out everything"""
+        return
+
     def version(self) -> str:
         """Return the current version of the source code"""
         raise NotImplementedError()
@@ -95,11 +112,20 @@ class SourceManager:
     def apply(self, patch: PatchFile):
         """Apply a patch to the current source"""
         raise NotImplementedError()
+
+    def check(self, version: str, patches: List[PatchFile]) -> List[str]:
+        """Check if the patches apply, in order, to a version without checking it out.
+        Returns the error for each patch or None if it applies"""
+        raise NotImplementedError()
     
     def reset(self) -> None:
         """Reset the source after changes were made"""
         raise NotImplementedError()
 
+    def track(self, paths: List[str] = None) -> None:
+        """Let the manager know which files were changed outside of apply/write"""
+        pass
+
     def read(self, path: str):
         """Read a file from the source"""
         raise NotImplementedError()
@@ -108,6 +134,14 @@ class SourceManager:
         """Write a file to the source"""
         raise NotImplementedError()
 
-    def list_files(self) -> List[str]:
-        """List all files in the source"""
+    def list_files(self, version=None, untracked=False) -> List[str]:
+        """List all files in the source (or in a version of it)"""
         raise NotImplementedError()
+
+    def tree_id(self, version=None) -> str:
+        """Return an id that changes whenever the files of version (default the current one) change"""
+        return None
+
+    def close(self) -> None:
+        """Release anything the manager is holding on to"""
+        pass
@@ -0,0 +1,205 @@
+# A small unified diff engine that applies patches to file contents in memory.
+# It lets us check and port patches against blobs read straight out of git,
+# without a working tree (or a fork of git apply) per attempt
+from typing import Callable, Dict, List
+
+from shipyard.patch import PatchFile, _strip_path
+
+class HunkLines:
+    """A single @@ block. lines are (op, text) with op one of ' ', '-', '+' and text
+    keeping its trailing newline (if it has one)"""
+    def __init__(self, old_start: int, new_start: int) -> None:
+        self.old_start = old_start
+        self.new_start = new_start
+        self.lines = []
+
+    @property
+    def old(self) -> List[str]:
+        return [t for op, t in self.lines if op != "+"]
+
+    @property
+    def new(self) -> List[str]:
+        return [t for op, t in self.lines if op != "-"]
+
+class FileHunks:
+    """The hunks for a single file. Paths are None for /dev/null"""
+    def __init__(self, old_path: str, new_path: str) -> None:
+        self.old_path = old_path
+        self.new_path = new_path
+        self.hunks: List[HunkLines] = []
+
+    @property
+    def path(self) -> str:
+        return self.new_path if self.new_path is not None else self.old_path
+
+class HunkResult:
+    def __init__(self, number: int, applied: bool, offset=0, fuzz=0) -> None:
+        self.number = number # 1 based, like patch(1) reports them
+        self.applied = applied
+        self.offset = offset
+        self.fuzz = fuzz
+
+    def __repr__(self) -> str:
+        if not self.applied:
+            return f"Hunk #{self.number} FAILED"
+        return f"Hunk #{self.number} succeeded (offset {self.offset}, fuzz {self.fuzz})"
+
+class PatchResult:
+    """Everything an apply produced. files maps each path to its new contents (None if the
+    patch deletes it) and hunks maps each path to the result of each of its hunks"""
+    def __init__(self) -> None:
+        self.files: Dict[str, str] = {}
+        self.hunks: Dict[str, List[HunkResult]] = {}
+        self.errors: List[str] = []
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors and all(h.applied for hs in self.hunks.values() for h in hs)
+
+    def report(self) -> str:
+        """A human readable list of everything that did not apply"""
+        lines = list(self.errors)
+        for p, hs in self.hunks.items():
+            lines += [f"{p}: {h}" for h in hs if not h.applied]
+        return "\n".join(lines)
+
+class UnsupportedPatch(ValueError):
+    """The patch uses something (binary diffs, renames) the engine does not handle"""
+
+
+def split_lines(s: str) -> List[str]:
+    """Split on \\n only, keeping the line endings"""
+    lines = s.split("\n")
+    last = lines.pop()
+    lines = [l + "\n" for l in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+def parse(patch, strip=1) -> List[FileHunks]:
+    """Turn a patch (a PatchFile or diff text) into hunks the engine can apply. Hunk line
+    counts come from the body, like git apply --recount"""
+    if isinstance(patch, str):
+        patch = PatchFile(patch)
+    files = []
+    for rec in patch.files:
+        for line in rec.header.splitlines():
+            if line.startswith("GIT binary patch") or line.startswith("Binary files ") \
+                    or line.startswith("rename from ") or line.startswith("copy from "):
+                raise UnsupportedPatch(line.strip())
+        cur = FileHunks(_strip_path(rec.old, strip), _strip_path(rec.new, strip))
+        files.append(cur)
+        for r in rec.hunks:
+            hunk = HunkLines(r.old_start, r.new_start)
+            cur.hunks.append(hunk)
+            body = r.body
+            if not body.endswith("\n"):
+                body += "\n" # PatchFile drops the newline at the end of the patch
+            for line in split_lines(body):
+                if line[:1] in (" ", "-", "+"):
+                    hunk.lines.append((line[0], line[1:]))
+                elif line.startswith("\\"):
+                    # "\ No newline at end of file" applies to the line before it
+                    if hunk.lines:
+                        op, t = hunk.lines[-1]
+                        hunk.lines[-1] = (op, t[:-1] if t.endswith("\n") else t)
+                else:
+                    hunk.lines.append(("=", line)) # Context line that lost its leading space
+            # Bare blank lines at the end of a hunk are not context, the rest are
+            while hunk.lines and hunk.lines[-1][0] == "=":
+                hunk.lines.pop()
+            hunk.lines = [(" " if op == "=" else op, t) for op, t in hunk.lines]
+    return files
+
+def _find(buf: List[str], old: List[str], pos: int, lo: int, at_start=False, at_end=False) -> int:
+    """Find old in buf starting at pos and moving outwards, never before lo. at_start and
+    at_end pin the match to the start or end of buf"""
+    n = len(old)
+    if at_start or at_end:
+        p = 0 if at_start else len(buf) - n
+        if p >= lo and (not at_end or p + n == len(buf)) and buf[p:p+n] == old:
+            return p
+        return -1
+    if not old:
+        return max(min(pos, len(buf)), lo)
+    for d in range(0, len(buf) + 1):
+        for p in ((pos - d, pos + d) if d else (pos,)):
+            if lo <= p <= len(buf) - n and buf[p:p+n] == old:
+                return p
+        if pos - d < lo and pos + d > len(buf) - n:
+            break
+    return -1
+
+def _context(lines) -> int:
+    """Number of context lines before the first change"""
+    return next((i for i, (op, _) in enumerate(lines) if op != " "), 0)
+
+def apply_hunks(contents: str, hunks: List[HunkLines], fuzz=0) -> "tuple[str, List[HunkResult]]":
+    """Apply hunks to contents, searching for offsets and (with fuzz > 0) dropping up to
+    fuzz lines of leading/trailing context. Hunks that do not apply are skipped.
+    Like git apply, a hunk starting at line 1 must match at the start of the file and
+    one without trailing context must match at the end"""
+    buf = split_lines(contents)
+    results = []
+    delta, lo = 0, 0
+    for n, h in enumerate(hunks, 1):
+        old, new = h.old, h.new
+        pos = h.old_start + delta - (1 if old else 0)
+        leading, trailing = _context(h.lines), _context(list(reversed(h.lines)))
+        applied = None
+        for f in range(0, fuzz + 1):
+            # Only context lines can be fuzzed away
+            head, tail = min(f, leading), min(f, trailing)
+            o = old[head:len(old)-tail]
+            p = _find(buf, o, pos + head, lo,
+                      at_start=h.old_start <= 1 and head == 0,
+                      at_end=trailing == 0 and bool(h.lines))
+            if p >= 0:
+                applied = (p, f, head, tail)
+                break
+            if head < f and tail < f:
+                break # Nothing left to fuzz
+        if applied is None:
+            results.append(HunkResult(n, False))
+            continue
+        p, f, head, tail = applied
+        nw = new[head:len(new)-tail]
+        offset = p - head - pos
+        buf[p:p+len(o)] = nw
+        results.append(HunkResult(n, True, offset=offset, fuzz=f))
+        delta += len(nw) - len(o) + offset
+        lo = p + len(nw)
+    return "".join(buf), results
+
+def apply_patch(patch, read: Callable[[str], str], fuzz=0, strip=1, files: Dict[str, str] = None) -> PatchResult:
+    """Apply a unified diff (a PatchFile or diff text) in memory
+
+    read: returns the contents of a path (str) or None if it does not exist
+    files: contents from earlier patches to apply on top of (path -> contents or None)
+    """
+    res = PatchResult()
+    files = dict(files or {})
+    for fd in parse(patch, strip=strip):
+        p = fd.path
+        if fd.old_path is None:
+            contents = ""
+            existing = files[p] if p in files else read(p)
+            if existing is not None:
+                res.errors.append(f"{p}: already exists")
+                continue
+        else:
+            contents = files[fd.old_path] if fd.old_path in files else read(fd.old_path)
+            if contents is None:
+                res.errors.append(f"{fd.old_path}: does not exist")
+                continue
+            if not isinstance(contents, str):
+                raise UnsupportedPatch(f"{fd.old_path} is not a text file")
+        new, results = apply_hunks(contents, fd.hunks, fuzz=fuzz)
+        res.hunks[p] = results
+        if fd.new_path is None:
+            if new:
+                res.errors.append(f"{p}: not empty after deleting it")
+            new = None
+        files[p] = new
+        res.files[p] = new
+    return res
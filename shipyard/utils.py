@@ -5,7 +5,7 @@ import inspect
 from os import path
 from typing import List
 
-from shipyard.version import Version
+from shipyard.version import Version, VersionIndex
 
 def _load_object(fil):
     """
@@ -25,27 +25,11 @@ def _load_object(fil):
 
 
 def getClosestVersions(version: str, versions: List[Version]) -> str:
-    """Get the versions closest to the passed in version, in order"""
-    vs = set(versions)
-    vs.add(version)
-    vs = sorted(vs)
-    idx = vs.index(version)
-    newVersions = []
-    left, right = idx-1, idx+1
-    while left >= 0 or right < len(vs):
-        if left >= 0:
-            nxt = vs[left]
-            if nxt != version:
-                newVersions.append(nxt)
-            left-=1
-        if right < len(vs):
-            nxt = vs[right]
-            if nxt != version:
-                newVersions.append(nxt)
-            right+=1
-    if not newVersions:
-        return [version]
-    return newVersions
+    """Get the versions closest to the passed in version, in order. Pass a VersionIndex
+    when calling this more than once on the same versions"""
+    if not isinstance(versions, VersionIndex):
+        versions = VersionIndex(versions)
+    return versions.closest(version) or [version]
 
 
 
@@ -1,5 +1,7 @@
 import re
 
+from bisect import bisect_left, bisect_right
+
 def _to_version_list(version) -> list:
     """Convert a version string into a list"""
     if isinstance(version, int):
@@ -8,6 +10,12 @@ def _to_version_list(version) -> list:
         version = str(version)
     return [int(i) for i in re.split(r"[^\d]", version) if i.isnumeric()]
 
+def _key(version) -> list:
+    """The sort key of a version, reusing the parsed one of a Version"""
+    if isinstance(version, Version):
+        return version._v
+    return _to_version_list(version)
+
 class Version(str):
     """
     Version is a custom string that allows us to easily compare against other version strings
@@ -23,19 +31,110 @@ class Version(str):
         return super().__hash__()
     
     def __lt__(self, other):
-        return self._v < _to_version_list(other)
+        return self._v < _key(other)
     
     def __gt__(self, other):
-        return self._v > _to_version_list(other)
+        return self._v > _key(other)
 
     def __eq__(self, other):
-        return self._v == _to_version_list(other)
+        return self._v == _key(other)
 
     def __le__(self, other) -> bool:
-        return self._v <= _to_version_list(other)
+        return self._v <= _key(other)
     
     def __ge__(self, other) -> bool:
-        return self._v >= _to_version_list(other)
+        return self._v >= _key(other)
+
+class VersionIndex:
+    """A sorted set of versions. Sort keys are parsed once, so lookups are a bisect
+    instead of a scan that re-parses every version it compares against
+
+    Versions that compare equal but are spelled differently (1.3.8 and 1.3.8a,
+    1.3.9.1 and 1.3.9rc1) are all kept, ordered by their string"""
+    def __init__(self, versions=()) -> None:
+        entries = {}
+        for v in versions:
+            if not isinstance(v, Version):
+                v = Version(v)
+            entries.setdefault((tuple(v._v), str(v)), v)
+        self._keys = sorted(entries) # Sorted (sort key, string) tuples
+        self._nums = [k for k, _ in self._keys] # Just the sort keys, for range lookups
+        self._versions = [entries[k] for k in self._keys] # The Version for each key
+
+    def add(self, version) -> Version:
+        """Add a version (if it is not there yet) and return the one in the index"""
+        if not isinstance(version, Version):
+            version = Version(version)
+        k = (tuple(version._v), str(version))
+        i = bisect_left(self._keys, k)
+        if i < len(self._keys) and self._keys[i] == k:
+            return self._versions[i]
+        self._keys.insert(i, k)
+        self._nums.insert(i, k[0])
+        self._versions.insert(i, version)
+        return version
+
+    def get(self, version, default=None) -> Version:
+        """The version in the index spelled like version or, failing that, the first one
+        equal to it"""
+        k = tuple(_key(version))
+        i = bisect_left(self._keys, (k, str(version)))
+        if i < len(self._keys) and self._keys[i] == (k, str(version)):
+            return self._versions[i]
+        i = bisect_left(self._nums, k)
+        if i < len(self._nums) and self._nums[i] == k:
+            return self._versions[i]
+        return default
+
+    def __contains__(self, version) -> bool:
+        return self.get(version) is not None
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+    def __iter__(self):
+        return iter(self._versions)
+
+    def __getitem__(self, i):
+        return self._versions[i]
+
+    def __repr__(self) -> str:
+        return f"VersionIndex({self._versions!r})"
+
+    def between(self, lo=None, hi=None) -> list:
+        """Versions with lo <= version <= hi. Either end can be left open"""
+        i = 0 if lo is None else bisect_left(self._nums, tuple(_key(lo)))
+        j = len(self._nums) if hi is None else bisect_right(self._nums, tuple(_key(hi)))
+        return self._versions[i:j]
+
+    def iter_closest(self, version):
+        """Yield the other versions, closest to version first: the ones equal to it but
+        spelled differently, then the one below, then the one above, and so on"""
+        k = tuple(_key(version))
+        left = bisect_left(self._nums, k)
+        right = bisect_right(self._nums, k)
+        for v in self._versions[left:right]:
+            if str(v) != str(version):
+                yield v
+        left -= 1
+        while left >= 0 or right < len(self._nums):
+            if left >= 0:
+                yield self._versions[left]
+                left -= 1
+            if right < len(self._nums):
+                yield self._versions[right]
+                right += 1
+
+    def closest(self, version) -> list:
+        """All the other versions, closest to version first"""
+        return list(self.iter_closest(version))
+
+    def nearest(self, version) -> Version:
+        """version itself if it is in the index, otherwise the closest one (or None)"""
+        v = self.get(version)
+        if v is not None:
+            return v
+        return next(self.iter_closest(version), None)
 
 if __name__ == '__main__':
     v = Version("openssh-7.9p1")
@@ -54,4 +153,12 @@ if __name__ == '__main__':
     assert v < 8.0
     assert v > 7.8
     assert v > 6
-    assert Version("openssh-7.9") == 7.9
\ No newline at end of file
+    assert Version("openssh-7.9") == 7.9
+
+    vi = VersionIndex(["1.0", "1.2", "2.0", "1.10", "1.2"])
+    assert list(vi) == ["1.0", "1.2", "1.10", "2.0"] and len(vi) == 4
+    assert "1.10" in vi and "1.3" not in vi
+    assert vi.closest("1.2") == ["1.0", "1.10", "2.0"]
+    assert vi.closest("1.5") == ["1.2", "1.10", "1.0", "2.0"]
+    assert vi.nearest("1.10") == "1.10" and vi.nearest("0.1") == "1.0"
+    assert vi.between("1.1", "1.10") == ["1.2", "1.10"]
@@ -0,0 +1,100 @@
+import os
+import sys
+import subprocess
+import textwrap
+
+import pytest
+
+VERSIONS = ["1.0", "1.1", "1.2", "2.0"]
+
+def git(cwd, *args, input=None) -> str:
+    res = subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        cwd=cwd,
+        input=input,
+        encoding="utf-8"
+    )
+    if res.returncode != 0:
+        raise AssertionError(f"git {' '.join(args)} failed: {res.stderr}")
+    return res.stdout
+
+def write(directory, files: dict):
+    for name, contents in files.items():
+        fpath = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, "w") as f:
+            f.write(contents)
+
+def version_files(v: str) -> dict:
+    """The upstream source at version v"""
+    return {
+        "main.c": f"int main() {{\n  // version {v}\n  return 0;\n}}\n",
+        "README": f"hello {v}\nline2\nline3\n",
+        "lib.c": "a\nb\nc\nd\ne\nf\n",
+        "src/x.h": f"#define X 1\n/* {v} */\n",
+    }
+
+def tag_version(repo, v: str, files: dict = None):
+    """Commit files (default version_files(v)) and tag the commit v<v>"""
+    write(repo, files or version_files(v))
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "--allow-empty", "-m", v)
+    git(repo, "tag", "-a", f"v{v}", "-m", v)
+
+@pytest.fixture
+def upstream(tmp_path):
+    """A git repo with an annotated tag for each of VERSIONS"""
+    repo = str(tmp_path / "upstream")
+    os.makedirs(repo)
+    git(repo, "init", "-q")
+    for v in VERSIONS:
+        tag_version(repo, v)
+    return repo
+
+SHIPFILE = '''\
+from shipyard import CodePatch, EZ
+class Shipfile:
+    Name = "up"
+    Url = "{url}"
+    Patches = "patches/"
+    VersionTags = "v*"
+{extra}
+    @staticmethod
+    def tag_to_version(tag): return tag.lstrip("v")
+    @staticmethod
+    def version_to_tag(v): return "v" + v
+{codepatches}
+'''
+
+HDR_CODEPATCH = '''
+    @CodePatch(r".*\\.h")
+    def hdr(file):
+        with EZ(file) as f:
+            f.replace("X 1", "X 2", err=True)
+'''
+
+@pytest.fixture
+def make_project(tmp_path, upstream, monkeypatch):
+    """make_project(patches={version: {name: text}}, extra="", codepatches=True, url=None)
+    writes a Shipfile project for url (default upstream) and changes into it. codepatches
+    is the source of the CodePatches in the Shipfile, True for HDR_CODEPATCH"""
+    def make(patches=None, extra="", codepatches=True, url=None):
+        proj = tmp_path / "project"
+        proj.mkdir()
+        shipfile = SHIPFILE.format(
+            url=url or upstream,
+            extra=textwrap.indent(textwrap.dedent(extra), "    "),
+            codepatches=HDR_CODEPATCH if codepatches is True else textwrap.indent(textwrap.dedent(codepatches or ""), "    "),
+        )
+        files = {"shipfile.py": shipfile}
+        for v, ps in (patches or {}).items():
+            for name, text in ps.items():
+                files[os.path.join("patches", v, name + ".patch")] = text
+        write(str(proj), files)
+        monkeypatch.chdir(proj)
+        # Shipfiles are imported as the module 'shipfile', load ours instead of a cached one
+        monkeypatch.setattr(sys, "path", list(sys.path))
+        monkeypatch.delitem(sys.modules, "shipfile", raising=False)
+        return str(proj)
+    return make
@@ -0,0 +1,59 @@
+import os
+import time
+
+from shipyard.cache import Cache, FileCache, digest
+
+def _age(cache, key, seconds):
+    t = time.time() - seconds
+    os.utime(cache._path(key), (t, t))
+
+def test_digest_separates_parts():
+    assert digest("ab", "c") != digest("a", "bc")
+    assert digest("a", 1) == digest("a", 1)
+
+def test_get_set(tmp_path):
+    c = Cache(str(tmp_path))
+    assert c.get("k", "default") == "default"
+    c.set("k", {"a": [1, 2]})
+    assert c.get("k") == {"a": [1, 2]}
+
+def test_expired_entries_are_dropped(tmp_path):
+    c = Cache(str(tmp_path), max_age=60)
+    c.set("old", 1)
+    _age(c, "old", 120)
+    assert c.get("old") is None
+    assert not os.path.exists(c._path("old"))
+
+def test_evicts_least_recently_used(tmp_path):
+    c = Cache(str(tmp_path))
+    for i in range(5):
+        c.set(f"k{i}", i)
+        _age(c, f"k{i}", 100 - i)
+    c.get("k0") # Used just now
+    # Eviction runs before the new entry is written
+    Cache(str(tmp_path), max_entries=3).set("new", 5)
+    left = sorted(e[:-len(".json")] for e in os.listdir(tmp_path))
+    assert left == ["k0", "k3", "k4", "new"]
+
+def test_evicts_down_to_max_size(tmp_path):
+    c = Cache(str(tmp_path))
+    for i in range(4):
+        c.set(f"k{i}", "x" * 1000)
+        _age(c, f"k{i}", 100 - i)
+    Cache(str(tmp_path), max_size=2500).set("new", "x" * 1000)
+    left = sorted(e[:-len(".json")] for e in os.listdir(tmp_path))
+    assert left == ["k2", "k3", "new"]
+
+def test_file_cache(tmp_path):
+    c = FileCache(str(tmp_path), suffix=".archive", max_entries=2)
+    assert c.get("a") is None
+    for i, key in enumerate(["a", "b", "c", "d"]):
+        tmp = c.new_file(key)
+        with open(tmp, "w") as f:
+            f.write(key)
+        assert c.commit(tmp, key) == c._path(key)
+        _age(c, key, 100 - i)
+        c._evicted = False # Evict on every commit
+    assert open(c.get("d")).read() == "d"
+    # Eviction runs before the new entry is stored
+    assert sorted(os.listdir(tmp_path)) == ["b.archive", "c.archive", "d.archive"]
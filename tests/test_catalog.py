@@ -0,0 +1,104 @@
+import os
+import subprocess
+
+import pytest
+
+from shipyard.catalog import VersionCatalog, git_common_dir
+from shipyard.sources import SourceProgram
+from conftest import git, tag_version, write
+
+class Shipfile:
+    Name = "up"
+    VersionTags = "v*"
+    IgnoredVersions = ["1.1"]
+
+    @staticmethod
+    def tag_to_version(tag):
+        return tag.lstrip("v")
+
+    @staticmethod
+    def version_to_tag(v):
+        return "v" + v
+
+    @staticmethod
+    def is_version_ignored(v):
+        return v in Shipfile.IgnoredVersions
+
+@pytest.fixture
+def repo(upstream, tmp_path):
+    r = SourceProgram.from_object(Shipfile)
+    r._filepath = str(tmp_path / "shipfile.py")
+    write(str(tmp_path), {"shipfile.py": "# v1\n"})
+    return r
+
+@pytest.fixture
+def git_calls(monkeypatch):
+    calls = []
+    run = subprocess.run
+    def counting_run(args, *a, **kw):
+        calls.append(args)
+        return run(args, *a, **kw)
+    monkeypatch.setattr(subprocess, "run", counting_run)
+    return calls
+
+def test_catalog_contents(upstream, repo):
+    cat = VersionCatalog(repo, upstream)
+    assert list(cat.versions()) == ["1.0", "1.2", "2.0"] # 1.1 is ignored
+    assert cat.tag("1.2") == "v1.2"
+    assert cat.commit("1.2") == git(upstream, "rev-parse", "v1.2^{commit}").strip()
+    assert cat.tree("1.2") == git(upstream, "rev-parse", "v1.2^{tree}").strip()
+    assert cat.tree("9.9") is None
+    assert cat.tag("9.9") == "v9.9" # Not a version, straight from the hook
+    assert cat.tags()["v1.1"] == git(upstream, "rev-parse", "v1.1^{commit}").strip() # Ignored, still a tag
+    assert os.path.isfile(os.path.join(upstream, ".git", "shipyard", "catalog.json"))
+
+def test_catalog_is_reused_without_git(upstream, repo, git_calls):
+    VersionCatalog(repo, upstream).versions()
+    assert git_calls
+    git_calls.clear()
+    cat = VersionCatalog(repo, upstream) # Loaded from disk
+    for _ in range(3):
+        assert list(cat.versions()) == ["1.0", "1.2", "2.0"]
+        cat.tree("2.0")
+    assert git_calls == []
+
+def test_new_and_moved_tags_invalidate(upstream, repo, git_calls):
+    cat = VersionCatalog(repo, upstream)
+    cat.versions()
+    tag_version(upstream, "3.0")
+    git_calls.clear()
+    assert list(cat.versions()) == ["1.0", "1.2", "2.0", "3.0"]
+    assert len(git_calls) == 2 # for-each-ref and the tree of the new commit
+
+    old_tree = cat.tree("2.0")
+    git(upstream, "tag", "-f", "v2.0", "v1.0")
+    assert cat.tree("2.0") != old_tree
+    assert cat.tree("2.0") == cat.tree("1.0")
+
+    git(upstream, "pack-refs", "--all")
+    git(upstream, "tag", "-d", "v3.0")
+    assert list(cat.versions()) == ["1.0", "1.2", "2.0"]
+
+def test_shipfile_change_runs_hooks_again(upstream, repo, tmp_path):
+    assert "1.1" not in VersionCatalog(repo, upstream).versions()
+    Shipfile.IgnoredVersions = []
+    try:
+        # The hooks are only called again once the shipfile changes
+        assert "1.1" not in VersionCatalog(repo, upstream).versions()
+        write(str(tmp_path), {"shipfile.py": "# v2\n"})
+        assert "1.1" in VersionCatalog(repo, upstream).versions()
+    finally:
+        Shipfile.IgnoredVersions = ["1.1"]
+
+def test_worktrees_share_the_catalog_dir(upstream, tmp_path):
+    wt = str(tmp_path / "wt")
+    git(upstream, "worktree", "add", "-q", "--detach", wt, "v1.0")
+    assert git_common_dir(wt) == git_common_dir(upstream) == os.path.join(upstream, ".git")
+
+def test_versions_that_sort_the_same_are_all_kept(upstream, repo):
+    for v in ["1.3.8", "1.3.8a", "1.3.7", "1.3.8b"]:
+        tag_version(upstream, v)
+    cat = VersionCatalog(repo, upstream)
+    assert [str(v) for v in cat.versions()] == ["1.0", "1.2", "1.3.7", "1.3.8", "1.3.8a", "1.3.8b", "2.0"]
+    assert cat.tag("1.3.8a") == "v1.3.8a"
+    assert cat.commit("1.3.8b") == git(upstream, "rev-parse", "v1.3.8b^{commit}").strip()
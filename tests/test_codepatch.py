@@ -0,0 +1,36 @@
+import re
+
+from shipyard.codepatch import CodePatch, CodePatchIndex
+
+def _funcs(*patterns):
+    funcs = []
+    for i, pattern in enumerate(patterns):
+        def f(file):
+            pass
+        f.__name__ = f"f{i}"
+        funcs.append(CodePatch(pattern)(f))
+    return funcs
+
+PATTERNS = [r".*\.h", r"src/.*\.c", r"Makefile", r"(a|b)\.c", r".*config.*", r"[^/]+/x\.h", r"lib.c$"]
+FILES = ["x.h", "src/x.h", "/src/main.c", "main.c", "a.c", "b.c", "Makefile", "sub/Makefile",
+         "etc/config.in", "config", "lib.c", "src/lib.c", "x.hh", "xh"]
+
+def test_match_agrees_with_fullmatch():
+    funcs = _funcs(*PATTERNS)
+    code_res = {}
+    for f, p in zip(funcs, PATTERNS):
+        code_res.setdefault(re.compile(p), []).append(f)
+    index = CodePatchIndex(code_res)
+    for rel in FILES:
+        expected = [f for r, fs in code_res.items() for f in fs if r.fullmatch(rel) or r.fullmatch(rel.lstrip("/"))]
+        assert index.match(rel) == expected, rel
+
+def test_runs_on_versions():
+    def any_version(file): pass
+    def only_old(file, version): pass
+    any_version = CodePatch(r".*")(any_version)
+    only_old = CodePatch(r".*", versions=["1.0"])(only_old)
+    index = CodePatchIndex({re.compile(r".*"): [any_version, only_old]})
+    assert index.takes_version == {any_version: False, only_old: True}
+    assert index.runs_on(only_old, "1.0") and index.runs_on(any_version, "2.0")
+    assert not index.runs_on(only_old, "2.0")
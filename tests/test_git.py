@@ -0,0 +1,146 @@
+import os
+import time
+
+import pytest
+
+from shipyard.patch import PatchFile
+from shipyard.patches import Patches
+from conftest import git, tag_version, write
+
+def _patch(name, text):
+    return PatchFile(f"{name}\n" + text, filename=f"/p/{name}.patch")
+
+PATCHES = [
+    _patch("lib", "--- a/lib.c\n+++ b/lib.c\n@@ -2,3 +2,3 @@\n b\n-c\n+C\n d\n"),
+    _patch("ver", "--- a/main.c\n+++ b/main.c\n@@ -1,3 +1,3 @@\n int main() {\n-  // version 1.1\n+  // patched\n   return 0;\n"),
+    _patch("new", "--- /dev/null\n+++ b/new.c\n@@ -0,0 +1 @@\n+new\n"),
+    # Only applies on top of lib
+    _patch("stack", "--- a/lib.c\n+++ b/lib.c\n@@ -2,3 +2,3 @@\n b\n-C\n+CC\n d\n"),
+    _patch("readme", "--- a/README\n+++ b/README\n@@ -1,2 +1,2 @@\n-hello 2.0\n+bye 2.0\n line2\n"),
+]
+
+def _applied(p, version) -> list:
+    """Which of PATCHES apply, one after the other, to a checkout of version"""
+    p._checkout(version)
+    return [p.source.apply(patch, reject=False, check=True) for patch in PATCHES]
+
+@pytest.mark.parametrize("backend", ["git", "batch"])
+def test_check_matches_worktree(make_project, backend):
+    make_project(codepatches=False)
+    p = Patches(".", backend=backend)
+    for v in p.source.versions():
+        errors = p.source.check(v, PATCHES)
+        assert [e is None for e in errors] == _applied(p, v), v
+        assert all(e for e in errors if e is not None)
+    assert [e is None for e in p.source.check("1.1", PATCHES)] == [True, True, True, True, False]
+
+def test_batch_reads_match_checkout(make_project):
+    make_project(codepatches=False)
+    p = Patches(".", backend="batch")
+    for v in ["1.0", "2.0"]:
+        files, header = p.source.list_files(v), p.source.read("src/x.h", v)
+        p._checkout(v)
+        assert files == git(p.infoObject.Directory, "ls-files").split()
+        assert header == p.source.read("src/x.h")
+    with pytest.raises(FileNotFoundError):
+        p.source.read("nope.c", "1.0")
+
+NEW_DIR = _patch("newdir", "--- /dev/null\n+++ b/new/dir/new.c\n@@ -0,0 +1 @@\n+new\n")
+
+def test_reset_restores_tracked_paths(make_project):
+    make_project(codepatches=False)
+    p = Patches(".")
+    src = p.infoObject.Directory
+    p._checkout("1.0")
+    p.source.apply(PATCHES[0])
+    p.source.apply(NEW_DIR)
+    write(src, {"scratch.txt": "not ours\n"})
+    assert sorted(git(src, "status", "--porcelain").splitlines()) == [" M lib.c", "?? new/", "?? scratch.txt"]
+
+    p.source.reset()
+    # Only what the patch touched is undone, the directories it made included
+    assert git(src, "status", "--porcelain").splitlines() == ["?? scratch.txt"]
+    assert not os.path.exists(os.path.join(src, "new"))
+
+    # Changes nobody tracked need a full reset
+    p.source.track()
+    p.source.reset()
+    assert git(src, "status", "--porcelain") == ""
+
+@pytest.mark.parametrize("backend", ["git", "batch"])
+@pytest.mark.parametrize("extra", ["", "FetchTagsOnly = True\nCloneFilter = 'blobless'"])
+def test_fetch_new_tags(make_project, upstream, backend, extra):
+    make_project(extra=extra)
+    p = Patches(".", backend=backend, cache=False)
+    assert list(p.source.versions()) == ["1.0", "1.1", "1.2", "2.0"]
+
+    tag_version(upstream, "3.0")
+    git(upstream, "tag", "unrelated")
+    new = p.source.fetch()
+    if extra:
+        assert new == ["v3.0"] # Only the VersionTags
+    else:
+        assert sorted(new) == ["unrelated", "v3.0"]
+    assert p.source.versions()[-1] == "3.0"
+    assert p.source.fetch() == []
+
+def test_partial_clone(make_project):
+    make_project(extra="FetchTagsOnly = True\nCloneFilter = 'blobless'")
+    p = Patches(".", cache=False)
+    src = p.infoObject.Directory
+    assert git(src, "config", "remote.origin.partialclonefilter").strip() == "blob:none"
+    # Only the tags were fetched, and the newest version is checked out
+    assert git(src, "for-each-ref", "--format=%(refname)", "refs/heads", "refs/remotes").split() == []
+    assert git(src, "describe", "--tags").strip() == "v2.0"
+    p._checkout("1.0")
+    assert p.source.read("README") == "hello 1.0\nline2\nline3\n"
+
+def test_batch_starts_one_cat_file(make_project, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import shipyard.gitbatch as gitbatch
+    started = []
+    class CountingCatFile(gitbatch.CatFile):
+        def __init__(self, directory):
+            started.append(directory)
+            time.sleep(0.05) # Let the other threads catch up
+            super().__init__(directory)
+    monkeypatch.setattr(gitbatch, "CatFile", CountingCatFile)
+
+    make_project()
+    p = Patches(".", backend="batch", cache=False, pull=False)
+    p.source.prepare()
+    with ThreadPoolExecutor(8) as ex:
+        contents = list(ex.map(lambda v: p.source.read("README", v), ["1.0", "1.1", "1.2", "2.0"] * 4))
+    assert [c.splitlines()[0] for c in contents[:4]] == ["hello 1.0", "hello 1.1", "hello 1.2", "hello 2.0"]
+    assert len(started) == 1
+
+@pytest.mark.parametrize("backend", ["git", "batch"])
+def test_version_of_checkout(make_project, backend):
+    make_project()
+    p = Patches(".", backend=backend, cache=False)
+    p._checkout("1.1")
+    assert p.source.version() == "v1.1"
+
+@pytest.mark.parametrize("backend", ["git", "batch"])
+def test_source_without_version_tags(tmp_path, make_project, capsys, backend):
+    repo = str(tmp_path / "untagged")
+    os.makedirs(repo)
+    git(repo, "init", "-q")
+    write(repo, {"lib.c": "a\nb\nc\nd\ne\nf\n"})
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", "untagged")
+    make_project(url=repo, codepatches=False)
+    p = Patches(".", backend=backend, cache=False)
+    assert list(p.source.versions()) == ["HEAD"]
+    assert p.source.list_files("HEAD") == ["lib.c"]
+    assert p.source.tree_id("HEAD") == git(repo, "rev-parse", "HEAD^{tree}").strip()
+    p.test_patch(PATCHES[0])
+    assert "[+] PASS HEAD" in capsys.readouterr().out
+
+def test_batch_check_adds_files_with_spaces(make_project):
+    make_project(codepatches=False)
+    p = Patches(".", backend="batch", cache=False)
+    assert p.source._object("tags/v1.0:new file.c") is None
+    new = _patch("spaced", "--- /dev/null\n+++ b/new file.c\n@@ -0,0 +1 @@\n+new\n")
+    assert p.source.check("1.0", [new]) == Patches(".", pull=False, cache=False).source.check("1.0", [new])
+    assert p.source.check("1.0", [new]) == [None]
@@ -0,0 +1,40 @@
+import asyncio
+import os
+
+from shipyard.gitasync import AsyncGitMgr
+from shipyard.patches import Patches
+from conftest import git
+
+PATCH = """\
+--- a/main.c
++++ b/main.c
+@@ -1,3 +1,3 @@
+ int main() {
+-  // version 1.1
++  // patched
+   return 0;
+"""
+
+def test_sync_reset_after_async_apply(make_project):
+    make_project(patches={"1.1": {"ver": PATCH}}, codepatches=False)
+    p = Patches(".", cache=False)
+    src = AsyncGitMgr(p.infoObject)
+
+    src.git.reset() # Clean, from now on it only restores the paths it knows changed
+    async def apply():
+        await src.checkout("1.1")
+        assert await src.apply(p.patches["ver"])
+    asyncio.run(apply())
+    assert git(p.infoObject.Directory, "status", "--porcelain") == " M main.c\n"
+    # Only the paths the async apply recorded are restored
+    src.git.reset()
+    assert git(p.infoObject.Directory, "status", "--porcelain") == ""
+
+def test_export(make_project):
+    make_project(patches={"1.1": {"ver": PATCH}}, codepatches=False)
+    p = Patches(".", cache=False)
+    src = AsyncGitMgr(p.infoObject)
+    out = asyncio.run(src.export("1.1", p.versions["1.1"]))
+    assert out.startswith("up 1.1\n")
+    assert "+  // patched" in out
+    assert git(p.infoObject.Directory, "status", "--porcelain") == ""
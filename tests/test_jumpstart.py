@@ -0,0 +1,58 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from shipyard.jumpstart import FastImport
+from conftest import git
+
+def make_tar(path, files: dict):
+    with tarfile.open(path, "w:gz") as tf:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    return str(path)
+
+@pytest.fixture
+def dest(tmp_path, monkeypatch):
+    for var in ("GIT_AUTHOR_NAME", "GIT_COMMITTER_NAME"):
+        monkeypatch.setenv(var, "test")
+    for var in ("GIT_AUTHOR_EMAIL", "GIT_COMMITTER_EMAIL"):
+        monkeypatch.setenv(var, "test@example.com")
+    d = str(tmp_path / "src")
+    os.makedirs(d)
+    git(d, "init", "-q")
+    return d
+
+def test_import_versions(tmp_path, dest):
+    a = make_tar(tmp_path / "up-1.0.tar.gz", {"up-1.0/a.c": b"one\n", "up-1.0/b/c.h": b"h\n"})
+    b = make_tar(tmp_path / "up-1.1.tar.gz", {"up-1.1/a.c": b"two\n"})
+    with FastImport(dest) as fi:
+        fi.add_version(a, "http://x/up-1.0.tar.gz", "1.0", "gztar")
+        fi.add_version(b, "http://x/up-1.1.tar.gz", "1.1", "gztar")
+    assert git(dest, "tag").split() == ["1.0", "1.1"]
+    assert git(dest, "ls-tree", "-r", "--name-only", "1.0").split() == ["a.c", "b/c.h"]
+    assert git(dest, "ls-tree", "-r", "--name-only", "1.1").split() == ["a.c"]
+    with open(os.path.join(dest, "a.c")) as f:
+        assert f.read() == "two\n"
+
+def test_failed_version_keeps_earlier_ones(tmp_path, dest):
+    a = make_tar(tmp_path / "up-1.0.tar.gz", {"a.c": b"one\n"})
+    b = make_tar(tmp_path / "up-1.1.tar.gz", {"a.c": b"two\n" * 100000, "z.c": b"z\n"})
+    with open(b, "rb") as f:
+        data = f.read()
+    with open(b, "wb") as f:
+        f.write(data[:len(data) // 2]) # Cut off in the middle of a.c
+
+    fi = FastImport(dest)
+    with pytest.raises(Exception):
+        with fi:
+            fi.add_version(a, "http://x/up-1.0.tar.gz", "1.0", "gztar")
+            fi.add_version(b, "http://x/up-1.1.tar.gz", "1.1", "gztar")
+    assert fi.imported == ["1.0"]
+    assert git(dest, "tag").split() == ["1.0"]
+    assert git(dest, "rev-parse", "HEAD") == git(dest, "rev-parse", "1.0^{commit}")
+    with open(os.path.join(dest, "a.c")) as f:
+        assert f.read() == "one\n"
@@ -0,0 +1,94 @@
+import os
+
+from shipyard.patch import PatchFile, parse_files
+from conftest import git, write
+
+GIT_DIFF = """\
+diff --git a/lib.c b/lib.c
+index 0fdf397..72ce94f 100644
+--- a/lib.c
++++ b/lib.c
+@@ -2,3 +2,3 @@
+ b
+-c
++C
+ d
+@@ -5,2 +5,3 @@
+ e
+ f
++g
+diff --git a/new.c b/new.c
+new file mode 100644
+index 0000000..1111111
+--- /dev/null
++++ b/new.c
+@@ -0,0 +1 @@
++new
+"""
+
+PLAIN_DIFF = """\
+--- a/README
++++ b/README
+@@ -1,3 +1,3 @@
+ hello 1.0
+-line2
++line2 patched
+ line3
+--- a/lib.c
++++ b/lib.c
+@@ -2,3 +2,3 @@
+ b
+-c
++C
+ d
+"""
+
+def test_parse_files_records():
+    files = parse_files(GIT_DIFF)
+    assert [(f.old_path, f.new_path, f.path) for f in files] == [("lib.c", "lib.c", "lib.c"), (None, "new.c", "new.c")]
+    lib, new = files
+    assert [(h.old_start, h.old_len, h.new_start, h.new_len) for h in lib.hunks] == [(2, 3, 2, 3), (5, 2, 5, 3)]
+    assert lib.hunks[0].body == " b\n-c\n+C\n d\n"
+    assert new.header.startswith("diff --git a/new.c b/new.c\nnew file mode 100644\n")
+    # Records are offsets into the original text
+    assert "".join(f.text for f in files) == GIT_DIFF
+
+def test_parse_files_skips_garbage_between_files():
+    files = parse_files("some text\n" + PLAIN_DIFF + "Signed-off-by: someone\n")
+    assert [f.path for f in files] == ["README", "lib.c"]
+    assert files[-1].text.endswith(" d\n")
+
+def test_patchfile_headers():
+    p = PatchFile("change both\nmore words\n" + PLAIN_DIFF, filename="/x/1.0/both.patch")
+    assert p.Name == "both"
+    assert p.Description == "change both\nmore words"
+    assert p.Index == "lib.c"
+    assert p.FullIndex == "b/lib.c"
+    assert p.paths == ["README", "lib.c"]
+    # Dumping and parsing again gives the same patch
+    again = PatchFile(p.dump())
+    assert again.Description == p.Description and again.paths == p.paths
+    assert again.dump() == p.dump()
+
+def test_record_roundtrip_is_lazy(tmp_path):
+    fname = str(tmp_path / "both.patch")
+    write(str(tmp_path), {"both.patch": "change both\n" + PLAIN_DIFF})
+    p = PatchFile.from_file(fname)
+    rec = p.to_record()
+    lazy = PatchFile.from_record(fname, rec)
+    assert lazy._lazy
+    assert lazy.digest == p.digest
+    assert (lazy.Name, lazy.Description, lazy.Index) == (p.Name, p.Description, p.Index)
+    assert lazy._lazy # Nothing above needed the file
+    assert lazy.paths == p.paths
+    assert lazy.dump() == p.dump()
+
+def test_plain_multi_file_diff_applies_with_git(tmp_path):
+    """Dumps add diff --git lines, so git apply --recount can tell where files end"""
+    repo = str(tmp_path)
+    git(repo, "init", "-q")
+    write(repo, {"README": "hello 1.0\nline2\nline3\n", "lib.c": "a\nb\nc\nd\ne\n"})
+    p = PatchFile(PLAIN_DIFF)
+    git(repo, "apply", "--recount", "-", input=p.dump())
+    with open(os.path.join(repo, "lib.c")) as f:
+        assert f.read() == "a\nb\nC\nd\ne\n"
@@ -0,0 +1,245 @@
+import os
+
+import pytest
+
+from shipyard.patch import PatchFile
+from shipyard.patches import Patches
+from conftest import git, tag_version, write
+
+# Passes on 1.1 only, main.c has the version in it
+MAIN_CODEPATCH = '''
+@CodePatch(r"main\\.c")
+def main(file):
+    with EZ(file) as f:
+        f.replace("version 1.1", "patched", err=True)
+'''
+
+HDR_CODEPATCH = '''
+@CodePatch(r".*\\.h")
+def hdr(file):
+    with EZ(file) as f:
+        f.replace("X 1", "X 2", err=True)
+'''
+
+C_CODEPATCH = '''
+@CodePatch(r".*\\.c")
+def cfiles(file):
+    with EZ(file) as f:
+        f.replace("return 0", "return 1")
+'''
+
+HDR_AND_MAIN = MAIN_CODEPATCH + HDR_CODEPATCH
+
+def _results(out):
+    """The PASS/FAIL line of each version, without the reason (it names the directory)"""
+    return sorted(l.split(":")[0] for l in out.splitlines() if "PASS" in l or "FAIL" in l)
+
+@pytest.mark.parametrize("name", ["main", "hdr"])
+def test_test_patch_in_worktrees_matches_serial(make_project, capsys, name):
+    make_project(codepatches=HDR_AND_MAIN)
+    p = Patches(".", cache=False)
+    head = git(p.infoObject.Directory, "rev-parse", "HEAD")
+    capsys.readouterr()
+
+    p.test_patch(name, jobs=3)
+    parallel = _results(capsys.readouterr().out)
+    # The worktrees are gone and the source directory was left alone
+    src = p.infoObject.Directory
+    assert len(git(src, "worktree", "list").splitlines()) == 1
+    assert git(src, "status", "--porcelain") == ""
+    assert git(src, "rev-parse", "HEAD") == head
+
+    p.test_patch(name)
+    serial = _results(capsys.readouterr().out)
+    assert parallel == serial
+    assert len(serial) == 4
+    if name == "main":
+        assert [l for l in serial if "PASS" in l] == ["[+] PASS 1.1"]
+
+def test_export_in_a_process_pool_matches_serial(make_project):
+    make_project(codepatches=C_CODEPATCH + HDR_CODEPATCH)
+    p = Patches(".", cache=False)
+    serial, ran = p.export("1.2")
+    parallel, ran_parallel = p.export("1.2", jobs=4)
+    assert parallel == serial
+    assert ran_parallel == ran
+    assert "+#define X 2" in serial and "+  return 1;" in serial
+
+def test_process_pool_raises_the_first_error(make_project):
+    make_project(codepatches=HDR_AND_MAIN)
+    p = Patches(".", cache=False)
+    errors = []
+    for jobs in (1, 4):
+        with pytest.raises(ValueError) as e:
+            p.export("1.0", jobs=jobs)
+        errors.append(str(e.value))
+    assert errors[0] == errors[1]
+    assert "failed to replace 'version 1.1'" in errors[0]
+
+def test_iter_files_lists_the_index(make_project, monkeypatch):
+    make_project(codepatches=False)
+    p = Patches(".")
+    src = p.infoObject.Directory
+    write(src, {".gitignore": "*.o\nbuild/\n", "new.c": "", "a.o": "", "build/x.c": ""})
+    rel = lambda files: sorted(os.path.relpath(f, src) for f in files)
+    assert rel(p.iter_files()) == ["README", "lib.c", "main.c", "src/x.h"]
+    assert rel(p.iter_files(untracked=True)) == [".gitignore", "README", "lib.c", "main.c", "new.c", "src/x.h"]
+
+    # The listing is kept per tree
+    calls = []
+    list_files = p.source.list_files
+    monkeypatch.setattr(p.source, "list_files", lambda *a, **kw: calls.append(a) or list_files(*a, **kw))
+    assert rel(p.iter_files()) == ["README", "lib.c", "main.c", "src/x.h"]
+    assert calls == []
+    p._checkout("1.0")
+    list(p.iter_files())
+    assert len(calls) == 1
+
+def test_iter_files_walks_other_directories(make_project, tmp_path):
+    make_project(codepatches=False)
+    p = Patches(".", pull=False)
+    d = str(tmp_path / "plain")
+    write(d, {".gitignore": "*.o\n", "a.c": "", "a.o": "", "sub/.gitignore": "gen/\n", "sub/b.c": "",
+              "sub/gen/c.c": "", "sub/d.o": "", ".git/config": ""})
+    files = sorted(os.path.relpath(f, d) for f in p.iter_files(d))
+    assert files == [".gitignore", "a.c", "sub/.gitignore", "sub/b.c"]
+
+def test_test_patch_results_are_stored(make_project, capsys, monkeypatch):
+    make_project(codepatches=HDR_AND_MAIN)
+    p = Patches(".")
+    p.test_patch("main")
+    first = _results(capsys.readouterr().out)
+
+    # Same trees, same shipfile: nothing runs again
+    p = Patches(".")
+    monkeypatch.setattr(Patches, "_test_code_patch", lambda *a: pytest.fail("ran again"))
+    p.test_patch("main")
+    assert _results(capsys.readouterr().out) == first
+
+README_PATCH = """\
+change the readme
+--- a/README
++++ b/README
+@@ -1,3 +1,3 @@
+ hello 1.1
+-line2
++line2 patched
+ line3
+"""
+
+def test_export_is_stored(make_project, monkeypatch):
+    proj = make_project(patches={"1.1": {"readme": README_PATCH}})
+    first, ran = Patches(".").export("1.1")
+    assert "+line2 patched" in first and "+#define X 2" in first
+
+    p = Patches(".")
+    monkeypatch.setattr(p, "_checkout", lambda v: pytest.fail("exported again"))
+    again, ran_again = p.export("1.1")
+    assert again == first
+    assert ran_again == ran
+
+    # A changed patch is exported again
+    write(proj, {"patches/1.1/readme.patch": README_PATCH.replace("line2 patched", "line2 changed")})
+    p = Patches(".")
+    assert "+line2 changed" in p.export("1.1")[0]
+
+def test_load_reads_unchanged_patches_from_the_index(make_project, monkeypatch):
+    proj = make_project(patches={"1.1": {"readme": README_PATCH}, "1.2": {"readme": README_PATCH.replace("1.1", "1.2")}})
+    p = Patches(".", pull=False)
+    assert os.path.isfile(os.path.join(proj, ".shipyard", "patches.json"))
+    parsed = []
+    from_file = PatchFile.from_file.__func__
+    monkeypatch.setattr(PatchFile, "from_file", classmethod(lambda cls, f: parsed.append(f) or from_file(cls, f)))
+
+    again = Patches(".", pull=False)
+    assert parsed == []
+    assert all(patch._lazy for patch in again.patches.values())
+    assert {v: [x.Description for x in ps] for v, ps in again.versions.items()} == \
+        {v: [x.Description for x in ps] for v, ps in p.versions.items()}
+
+    # Only the changed patch is parsed again
+    write(proj, {"patches/1.2/readme.patch": "new description\n" + README_PATCH.split("\n", 1)[1]})
+    again = Patches(".", pull=False)
+    assert parsed == [os.path.join(".", "patches", "1.2", "readme.patch")]
+    assert [x.Description for x in again.versions["1.2"]] == ["new description"]
+
+def test_sparse_checkout_writes_only_patched_files(make_project):
+    make_project(patches={"1.1": {"readme": README_PATCH}}, extra="SparseCheckout = True")
+    p = Patches(".", cache=False)
+    src = p.infoObject.Directory
+    on_disk = lambda: sorted(os.path.relpath(os.path.join(d, f), src) for d, _, fs in os.walk(src) if ".git" not in d for f in fs)
+    p._checkout("1.1")
+    assert on_disk() == ["README", "src/x.h"]
+    patch, _ = p.export("1.1")
+    assert "+line2 patched" in patch and "+#define X 2" in patch
+
+    p._checkout("1.1", full=True)
+    assert on_disk() == ["README", "lib.c", "main.c", "src/x.h"]
+
+# Version 1.1 has lines around the change that no other version has, so a patch
+# refreshed on 1.1 (with 3 lines of context) only applies to 1.1
+SOURCES = {
+    "1.0": "top\nb\nc\nd\nbottom\n",
+    "1.1": "top 1.1\nb\nc\nd\nbottom 1.1\n",
+    "1.2": "top\nb\nc\nd\nbottom\n",
+}
+
+MULTI = """\
+change c in both files
+--- a/one.c
++++ b/one.c
+@@ -2,3 +2,3 @@
+ b
+-c
++C
+ d
+--- a/two.c
++++ b/two.c
+@@ -2,3 +2,3 @@
+ b
+-c
++C
+ d
+"""
+
+def test_build_versions_falls_back_to_other_copies(tmp_path, make_project):
+    repo = str(tmp_path / "three")
+    os.makedirs(repo)
+    git(repo, "init", "-q")
+    for v, text in SOURCES.items():
+        tag_version(repo, v, {"one.c": text, "two.c": text})
+    proj = make_project(patches={"1.0": {"multi": MULTI}}, codepatches=False, url=repo)
+
+    p = Patches(".", cache=False)
+    ported = p.build_versions()
+    assert ported == {"1.1": ("1.0", ["multi"], []), "1.2": ("1.1", ["multi"], [])}
+    # 1.2 got its copy from the 1.0 patch, the one refreshed on 1.1 does not apply there
+    with open(os.path.join(proj, "patches", "1.1", "multi.patch")) as f:
+        assert "top 1.1" in f.read()
+    with open(os.path.join(proj, "patches", "1.2", "multi.patch")) as f:
+        assert "1.1" not in f.read()
+    assert [e for _, _, errs in p.matrix() for e in errs.values() if e] == []
+
+def test_build_versions_without_patches(make_project, capsys):
+    make_project(codepatches=False)
+    p = Patches(".", cache=False)
+    assert p.build_versions() == {}
+    assert "nothing to port" in capsys.readouterr().out
+
+def test_test_patch_prints_why_it_failed(make_project, capsys):
+    # main.c has the version in it, so the patch only applies to 1.1
+    patch = """\
+--- a/main.c
++++ b/main.c
+@@ -1,3 +1,3 @@
+ int main() {
+-  // version 1.1
++  // patched
+   return 0;
+"""
+    make_project(patches={"1.1": {"ver": patch}}, codepatches=False)
+    p = Patches(".", cache=False)
+    p.test_patch(p.patches["ver"])
+    out = capsys.readouterr().out
+    assert "[+] PASS 1.1" in out
+    assert "[!] FAIL 1.0: error: patch failed: main.c:1" in out
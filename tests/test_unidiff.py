@@ -0,0 +1,120 @@
+import random
+import subprocess
+
+import pytest
+
+from shipyard.unidiff import apply_patch, apply_hunks, parse, _find, UnsupportedPatch
+from conftest import git, write
+
+DIFF = """\
+--- a/f
++++ b/f
+@@ -2,3 +2,3 @@
+ b
+-c
++C
+ d
+"""
+
+def test_find_searches_outwards_from_pos():
+    buf = ["x\n", "a\n", "x\n", "a\n", "x\n"]
+    assert _find(buf, ["a\n"], 2, 0) == 1 # pos-1 is tried before pos+1
+    assert _find(buf, ["a\n"], 3, 0) == 3
+    assert _find(buf, ["a\n"], 0, 2) == 3 # Never before lo
+    assert _find(buf, ["nope\n"], 2, 0) == -1
+    assert _find(buf, [], 9, 0) == 5
+
+def test_find_pinned_to_start_and_end():
+    buf = ["a\n", "b\n", "a\n"]
+    assert _find(buf, ["a\n"], 2, 0, at_start=True) == 0
+    assert _find(buf, ["a\n"], 0, 0, at_end=True) == 2
+    assert _find(buf, ["b\n"], 1, 0, at_start=True) == -1
+
+def test_apply_with_offset():
+    res = apply_patch(DIFF, lambda p: "new\nnew\na\nb\nc\nd\ne\n" if p == "f" else None)
+    assert res.ok
+    assert res.files["f"] == "new\nnew\na\nb\nC\nd\ne\n"
+    assert res.hunks["f"][0].offset == 2
+
+def test_apply_reports_failed_hunks():
+    res = apply_patch(DIFF, lambda p: "a\nb\nX\nd\n")
+    assert not res.ok
+    assert "Hunk #1 FAILED" in res.report()
+
+def test_fuzz_drops_context():
+    contents = "a\nB\nc\nd\n"
+    hunks = parse(DIFF)[0].hunks
+    _, results = apply_hunks(contents, hunks)
+    assert not results[0].applied
+    new, results = apply_hunks(contents, hunks, fuzz=1)
+    assert results[0].applied and results[0].fuzz == 1
+    assert new == "a\nB\nC\nd\n"
+
+def test_new_and_deleted_files():
+    diff = "--- /dev/null\n+++ b/new.c\n@@ -0,0 +1,2 @@\n+one\n+two\n--- a/old.c\n+++ /dev/null\n@@ -1 +0,0 @@\n-gone\n"
+    files = {"old.c": "gone\n"}
+    res = apply_patch(diff, files.get)
+    assert res.ok
+    assert res.files == {"new.c": "one\ntwo\n", "old.c": None}
+    res = apply_patch(diff, lambda p: "exists\n")
+    assert "new.c: already exists" in res.errors
+
+def test_patches_stack_through_files():
+    first = apply_patch(DIFF, lambda p: "a\nb\nc\nd\n")
+    second = "--- a/f\n+++ b/f\n@@ -2,3 +2,3 @@\n b\n-C\n+CC\n d\n"
+    res = apply_patch(second, lambda p: None, files=first.files)
+    assert res.ok and res.files["f"] == "a\nb\nCC\nd\n"
+
+def test_unsupported_patches():
+    binary = "diff --git a/x.bin b/x.bin\nindex 1..2 100644\nGIT binary patch\nliteral 1\nAc\n\n"
+    with pytest.raises(UnsupportedPatch):
+        apply_patch(binary, lambda p: "")
+    with pytest.raises(UnsupportedPatch):
+        apply_patch(DIFF, lambda p: b"\xff\x00")
+
+def _random_lines(rng):
+    return [f"line {rng.randint(0, 30)}\n" for _ in range(rng.randint(0, 60))]
+
+@pytest.mark.parametrize("seed", range(4))
+def test_agrees_with_git_apply(tmp_path, seed):
+    """Random edits diffed by git, applied to a randomly drifted copy by both engines"""
+    rng = random.Random(seed)
+    git(str(tmp_path), "init", "-q")
+    checked = 0
+    for trial in range(60):
+        a = _random_lines(rng)
+        b = list(a)
+        for _ in range(rng.randint(1, 4)):
+            i = rng.randrange(len(b) + 1)
+            r = rng.random()
+            if r < 0.4 and i < len(b):
+                del b[i]
+            elif r < 0.8:
+                b.insert(i, f"new {rng.randint(0, 9)}\n")
+            elif i < len(b):
+                b[i] = "changed\n"
+        if rng.random() < 0.2 and b:
+            b[-1] = b[-1].rstrip("\n")
+        target = list(a)
+        for _ in range(rng.randint(0, 3)):
+            target.insert(rng.randrange(len(target) + 1), f"extra {rng.randint(0, 9)}\n")
+        write(str(tmp_path), {"a": "".join(a), "b": "".join(b), "f": "".join(target)})
+        diff = subprocess.run(
+            ["git", "diff", "--no-index", "--no-prefix", "a", "b"],
+            stdout=subprocess.PIPE, cwd=tmp_path, encoding="utf-8"
+        ).stdout
+        if not diff:
+            continue
+        diff = diff.replace("--- a\n", "--- a/f\n").replace("+++ b\n", "+++ b/f\n")
+        ok = subprocess.run(
+            ["git", "apply", "--check", "--recount", "-"],
+            input=diff, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=tmp_path, encoding="utf-8"
+        ).returncode == 0
+        res = apply_patch(diff, lambda p: "".join(target) if p == "f" else None)
+        assert res.ok == ok, f"trial {trial}: git {'applies' if ok else 'rejects'}\n{diff}\n{res.report()}"
+        if ok:
+            git(str(tmp_path), "apply", "--recount", "-", input=diff)
+            with open(tmp_path / "f") as f:
+                assert res.files["f"] == f.read()
+        checked += 1
+    assert checked > 30
@@ -0,0 +1,39 @@
+from shipyard.version import Version, VersionIndex
+
+def test_version_ordering():
+    assert Version("openssh-7.9p1") == "7.9.1"
+    assert Version("7.9") < Version("7.10")
+    assert sorted(Version(v) for v in ["2.0", "1.10", "1.2"]) == ["1.2", "1.10", "2.0"]
+
+def test_index_sorts_and_dedupes():
+    idx = VersionIndex(["2.0", "1.10", "1.2", "1.2"])
+    assert list(idx) == ["1.2", "1.10", "2.0"]
+    assert len(idx) == 3
+    assert "1.10" in idx and "1.3" not in idx
+    assert idx.get("v2.0") == "2.0"
+    assert idx[-1] == "2.0"
+
+def test_index_keeps_versions_spelled_differently():
+    idx = VersionIndex(["1.3.8b", "1.3.8", "1.3.7", "1.3.8a", "1.3.9rc1", "1.3.9.1"])
+    assert [str(v) for v in idx] == ["1.3.7", "1.3.8", "1.3.8a", "1.3.8b", "1.3.9.1", "1.3.9rc1"]
+    assert str(idx.get("1.3.8a")) == "1.3.8a"
+    assert str(idx.get("v1.3.8")) == "1.3.8" # Equal to it, nothing spelled the same
+    assert [str(v) for v in idx.between("1.3.8", "1.3.8")] == ["1.3.8", "1.3.8a", "1.3.8b"]
+    assert [str(v) for v in idx.closest("1.3.8a")] == ["1.3.8", "1.3.8b", "1.3.7", "1.3.9.1", "1.3.9rc1"]
+
+def test_index_add():
+    idx = VersionIndex(["1.0", "3.0"])
+    assert idx.add("2.0") == "2.0"
+    assert idx.add("2.0") is idx.get("2.0") # Already there
+    assert str(idx.add("v2.0")) == "v2.0"
+    assert [str(v) for v in idx] == ["1.0", "2.0", "v2.0", "3.0"]
+
+def test_index_lookups():
+    idx = VersionIndex(["1.0", "1.1", "1.2", "2.0", "3.0"])
+    assert idx.between("1.1", "2.0") == ["1.1", "1.2", "2.0"]
+    assert idx.between(hi="1.0") == ["1.0"]
+    assert idx.closest("1.2") == ["1.1", "2.0", "1.0", "3.0"]
+    assert idx.closest("1.5") == ["1.2", "2.0", "1.1", "3.0", "1.0"]
+    assert idx.nearest("1.2") == "1.2"
+    assert idx.nearest("9.0") == "3.0"
+    assert VersionIndex().nearest("1.0") is None